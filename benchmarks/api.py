@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  api.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Load test of the public API against synthetic catalogs
+
+Builds a catalog of each size, with the same seed giving the same games
+every time, then drives every public endpoint through Flask's test client,
+or through a local uWSGI instance with --uwsgi. Every catalog is served by
+a fresh process, so peak RSS is measured per catalog. Reports p50/p99
+latency, requests per second and peak RSS as JSON.
+
+Usage: benchmarks/api.py [--sizes 1000,100000,1000000] [--requests 200]
+       [--max-seconds 10] [--seed 1] [--uwsgi] [--processes 5]
+       [--concurrency 8]
+"""
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import resource
+import tempfile
+import subprocess
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+GENRES = ["FPS", "RTS", "RPG", "open-source", "multiplayer", "puzzle", "racing", "platformer",
+          "sandbox", "survival", "strategy", "arcade", "retro", "indie", "simulation"]
+RATINGS = ["E", "E10+", "T", "M"]
+PLATFORMS = ["linux", "wine", "emulator", "native"]
+WORDS = ["space", "arena", "quest", "dungeon", "racing", "classic", "open", "world", "tactical",
+         "pixel", "retro", "physics", "online", "story", "adventure", "castle", "robot", "ocean",
+         "zombie", "farm", "kart", "tower", "defense", "card", "galaxy", "ninja", "dragon"]
+
+
+def make_game(rng, index):
+    """Make one synthetic game, in the import format"""
+    return {"Name": "game_%d" % (index), "URL": "https://example.com/games/%d.tar.gz" % (index),
+            "platform": rng.choice(PLATFORMS), "genres": rng.sample(GENRES, rng.randint(1, 4)),
+            "rating": rng.choice(RATINGS), "downloads": int(rng.paretovariate(1.2)),
+            "joined": 1600000000 + rng.randrange(100000000), "in_pack_man": rng.random() < 0.2,
+            "screenshots_url": "https://example.com/screenshots/%d" % (index),
+            "description": " ".join(rng.choice(WORDS) for each in range(rng.randint(8, 30)))}
+
+
+def build_catalog(folder, games, seed):
+    """Make a DB of `games' synthetic games, and the settings to serve it
+
+    Returns how long it took, in seconds.
+    """
+    from database import Database
+    from schema import migrate
+    from bulk import import_games
+    start = time.perf_counter()
+    database = Database(os.path.join(folder, "bench.sql"))
+    migrate(database.get())
+    rng = random.Random(seed)
+    report = import_games(database, enumerate(make_game(rng, each) for each in range(games)),
+                          batch_size=50000)
+    database.close()
+    if report["errors"] != []:
+        raise RuntimeError("Could not build the catalog: %s" % (report["errors"][0]))
+    with open(os.path.join(ROOT, "settings.json"), "r") as file:
+        settings = json.load(file)
+    settings.update({"db_name": os.path.join(folder, "bench.sql"),
+                     "secrets_file": os.path.join(folder, "auth.json"),
+                     "credential_store": "json",
+                     "metrics_spool": os.path.join(folder, "metrics")})
+    # Every request comes from the same client, so limiting them would only measure the limiter
+    settings["rate_limit"]["enabled"] = False
+    with open(os.path.join(folder, "settings.json"), "w") as file:
+        json.dump(settings, file, indent=4)
+    shutil.copy(os.path.join(ROOT, "auth.json"), os.path.join(folder, "auth.json"))
+    return round(time.perf_counter() - start, 3)
+
+
+def endpoints(games):
+    """Get the endpoints to drive, and how to pick a path for each"""
+    def name(rng):
+        return "game_%d" % (rng.randrange(games))
+    return {"/games": lambda rng: "/games",
+            "/games?limit=100": lambda rng: "/games?limit=100",
+            "/games/<name>": lambda rng: "/games/" + name(rng),
+            "/games/<name>/download": lambda rng: "/games/%s/download" % (name(rng)),
+            "/search/tags=...": lambda rng: "/search/tags=" + ",".join(rng.sample(GENRES, 2)),
+            "/search/free-text=...": lambda rng: "/search/free-text=" + "%20".join(rng.sample(WORDS, 2)),
+            "/suggest/<prefix>": lambda rng: "/suggest/" + rng.choice(WORDS)[:rng.randint(1, 4)],
+            "/tags": lambda rng: "/tags"}
+
+
+def summarize(latencies, errors, elapsed):
+    """Get p50/p99 latency, in ms, and requests per second"""
+    latencies = sorted(latencies)
+    return {"requests": len(latencies), "errors": errors,
+            "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+            "p99_ms": round(latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000, 3),
+            "rps": round(len(latencies) / elapsed, 1)}
+
+
+def drive(get, games, requests, max_seconds, seed, concurrency=1):
+    """Send `requests' requests to every endpoint, or as many as fit in
+    `max_seconds'
+
+    `get' sends one request for a path, returning its status code. The
+    first request to each endpoint is timed on its own, since it may fill
+    caches.
+    """
+    output = {}
+    for endpoint, path in endpoints(games).items():
+        rng = random.Random(seed)
+        start = time.perf_counter()
+        get(path(rng))
+        first = time.perf_counter() - start
+        paths = [path(rng) for each in range(requests)]
+        latencies = []
+        errors = 0
+        deadline = time.perf_counter() + max_seconds
+
+        def timed(each):
+            if time.perf_counter() > deadline:
+                return None
+            start = time.perf_counter()
+            status = get(each)
+            return time.perf_counter() - start, status
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for result in pool.map(timed, paths):
+                if result is None:
+                    continue
+                latencies.append(result[0])
+                if result[1] != 200:
+                    errors += 1
+        output[endpoint] = summarize(latencies, errors, time.perf_counter() - start)
+        output[endpoint]["first_ms"] = round(first * 1000, 3)
+    return output
+
+
+def serve_test_client(args):
+    """Drive the catalog in the current directory through the test client
+
+    Runs in a process of its own, so peak RSS belongs to this catalog.
+    """
+    start = time.perf_counter()
+    import store
+    client = store.create_app().test_client()
+    load = time.perf_counter() - start
+
+    def get(path):
+        response = client.get(path)
+        response.get_data()
+        return response.status_code
+
+    output = {"import_s": round(load, 3),
+              "endpoints": drive(get, args.games, args.requests, args.max_seconds, args.seed)}
+    output["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps(output))
+
+
+def free_port():
+    """Get a free local TCP port"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def tree_peak_rss(pid):
+    """Get the summed peak RSS, in KB, of a process and its children"""
+    total = 0
+    pids = [pid]
+    while pids != []:
+        each = pids.pop()
+        try:
+            with open("/proc/%d/status" % (each), "r") as file:
+                for line in file:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1])
+            with open("/proc/%d/task/%d/children" % (each, each), "r") as file:
+                pids.extend([int(child) for child in file.read().split()])
+        except OSError:
+            continue
+    return total
+
+
+def serve_uwsgi(folder, args):
+    """Drive the catalog in `folder' through a local uWSGI instance"""
+    uwsgi = shutil.which("uwsgi")
+    if uwsgi is None:
+        return {"error": "uwsgi is not installed"}
+    port = free_port()
+    start = time.perf_counter()
+    server = subprocess.Popen([uwsgi, "--http", "127.0.0.1:%d" % (port), "--master",
+                               "--processes", str(args.processes), "--enable-threads",
+                               "--module", "wsgi:app", "--pythonpath", ROOT, "--chdir", folder,
+                               "--need-app", "--disable-logging"],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = "http://127.0.0.1:%d" % (port)
+    try:
+        while True:
+            try:
+                urllib.request.urlopen(base + "/tags", timeout=5).read()
+                break
+            except OSError:
+                if server.poll() is not None or time.perf_counter() - start > 600:
+                    return {"error": "uwsgi did not start"}
+                time.sleep(0.2)
+        load = time.perf_counter() - start
+
+        def get(path):
+            try:
+                with urllib.request.urlopen(base + urllib.parse.quote(path, safe="/?=&,%"),
+                                            timeout=60) as response:
+                    response.read()
+                    return response.status
+            except urllib.error.HTTPError as error:
+                return error.code
+
+        output = {"import_s": round(load, 3), "processes": args.processes,
+                  "concurrency": args.concurrency,
+                  "endpoints": drive(get, args.games, args.requests, args.max_seconds, args.seed,
+                                     concurrency=args.concurrency)}
+        output["peak_rss_kb"] = tree_peak_rss(server.pid)
+        return output
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    """Run the benchmark"""
+    parser = argparse.ArgumentParser(description="Load test of the public API")
+    parser.add_argument("--sizes", default="1000,100000,1000000",
+                        help="Comma delimited catalog sizes")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per endpoint")
+    parser.add_argument("--max-seconds", type=float, default=10.0,
+                        help="Time limit per endpoint")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--uwsgi", action="store_true", help="Serve through a local uWSGI")
+    parser.add_argument("--processes", type=int, default=5, help="uWSGI worker processes")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Requests in flight at once, with --uwsgi")
+    # Used internally, to serve one catalog in a fresh process
+    parser.add_argument("--serve", help=argparse.SUPPRESS)
+    parser.add_argument("--games", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve is not None:
+        os.chdir(args.serve)
+        serve_test_client(args)
+        return
+    output = {"seed": args.seed, "mode": "uwsgi" if args.uwsgi else "test_client", "catalogs": []}
+    for games in [int(each) for each in args.sizes.split(",")]:
+        folder = tempfile.mkdtemp(prefix="vetala-bench-")
+        try:
+            result = {"games": games, "build_s": build_catalog(folder, games, args.seed)}
+            if args.uwsgi:
+                result.update(serve_uwsgi(folder, argparse.Namespace(**dict(vars(args), games=games))))
+            else:
+                served = subprocess.run([sys.executable, os.path.abspath(__file__), "--serve", folder,
+                                         "--games", str(games), "--requests", str(args.requests),
+                                         "--max-seconds", str(args.max_seconds),
+                                         "--seed", str(args.seed)],
+                                        stdout=subprocess.PIPE, check=True)
+                result.update(json.loads(served.stdout.decode().strip().splitlines()[-1]))
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+        output["catalogs"].append(result)
+        print("Finished %d games" % (games), file=sys.stderr)
+    print(json.dumps(output, indent=2))
+
+
+if __name__ == "__main__":
+    main()
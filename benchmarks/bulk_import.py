@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  bulk_import.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Bulk import speed, for a fresh import and for re-importing the same games
+
+Usage: benchmarks/bulk_import.py [games]
+"""
+import sys
+import os
+import io
+import json
+import time
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from database import Database
+from schema import migrate
+from bulk import read_games, import_games
+
+
+def make_ndjson(games):
+    """Make an NDJSON catalog of `games' games"""
+    return "".join([json.dumps({"Name": "game_%d" % (each), "URL": "https://example.com/%d" % (each),
+                                "platform": "linux", "genres": ["FPS", "open-source"],
+                                "rating": "E", "description": "Description of game %d" % (each),
+                                "joined": 1623351659, "downloads": each}) + "\n"
+                    for each in range(games)])
+
+
+def time_import(database, text):
+    """Import `text', returning the report and how long it took"""
+    start = time.perf_counter()
+    report = import_games(database, read_games(io.StringIO(text)))
+    return report, round(time.perf_counter() - start, 3)
+
+
+def main(games=50000):
+    """Run the benchmark"""
+    text = make_ndjson(games)
+    with tempfile.TemporaryDirectory() as folder:
+        database = Database(os.path.join(folder, "bench.sql"))
+        migrate(database.get())
+        report, fresh = time_import(database, text)
+        again, update = time_import(database, text)
+        database.close()
+    print(json.dumps({"games": games, "imported": report["imported"], "errors": len(report["errors"]),
+                      "fresh_s": fresh, "reimport_s": update,
+                      "games_per_s": round(games / fresh)}, indent=2))
+
+
+if __name__ == "__main__":
+    main(*[int(each) for each in sys.argv[1:]])
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  kdf.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Cost of the password hashing settings, and what a login flood does to the
+rest of the process
+
+For each setting, reports how long one hash takes, how many logins per
+second `slots' hashing slots can check, and how late a 1ms timer on another
+thread (a stand-in for requests being served meanwhile) wakes up while every
+slot is taken.
+
+Usage: benchmarks/kdf.py [logins] [slots]
+"""
+import sys
+import os
+import json
+import time
+import tempfile
+import threading
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from passwords import PasswordHasher, Busy, legacy_hash
+
+
+SETTINGS = [("legacy", {"hash_algo": "sha512", "rehash_count": 2500}),
+            ("scrypt", {"n": 8192, "r": 8, "p": 1}),
+            ("scrypt", {"n": 16384, "r": 8, "p": 1}),
+            ("scrypt", {"n": 32768, "r": 8, "p": 1}),
+            ("pbkdf2", {"hash_name": "sha256", "iterations": 300000}),
+            ("pbkdf2", {"hash_name": "sha256", "iterations": 600000})]
+
+
+def make_record(hasher, kdf, params):
+    """Make a record for the password "password" with the given setting"""
+    if kdf == "legacy":
+        return dict(params, password_hash=legacy_hash("password", params["hash_algo"],
+                                                      params["rehash_count"]))
+    return hasher.make("password", kdf=kdf)
+
+
+def watch(stop, lateness):
+    """Sleep 1ms at a time, recording how late each wakeup is"""
+    while not stop.is_set():
+        start = time.perf_counter()
+        time.sleep(0.001)
+        lateness.append((time.perf_counter() - start - 0.001) * 1000)
+
+
+def flood(hasher, record, logins, slots):
+    """Check `logins' passwords from `slots' * 3 threads at once
+
+    Only `slots' hashes run at once, so some get turned away.
+    """
+    done = []
+    busy = []
+
+    def login():
+        while len(done) + len(busy) < logins:
+            try:
+                hasher.verify(record, "password")
+                done.append(1)
+            except Busy:
+                busy.append(1)
+                time.sleep(0.01)
+
+    stop = threading.Event()
+    lateness = []
+    watcher = threading.Thread(target=watch, args=(stop, lateness))
+    watcher.start()
+    threads = [threading.Thread(target=login) for each in range(slots * 3)]
+    start = time.perf_counter()
+    for each in threads:
+        each.start()
+    for each in threads:
+        each.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    watcher.join()
+    lateness.sort()
+    return {"logins_per_s": round(len(done) / elapsed, 1),
+            "turned_away": len(busy),
+            "timer_late_p50_ms": round(lateness[len(lateness) // 2], 3),
+            "timer_late_p99_ms": round(lateness[int(len(lateness) * 0.99)], 3)}
+
+
+def main(logins=40, slots=2):
+    """Run the benchmark"""
+    output = []
+    slots_file = os.path.join(tempfile.mkdtemp(prefix="vetala-kdf-"), "slots")
+    for kdf, params in SETTINGS:
+        options = {"max_concurrent": slots, "slots_file": slots_file}
+        if kdf != "legacy":
+            options.update({"kdf": kdf, kdf: params})
+        hasher = PasswordHasher(**options)
+        record = make_record(hasher, kdf, params)
+        start = time.perf_counter()
+        hasher.verify(record, "password")
+        single = time.perf_counter() - start
+        result = {"kdf": kdf, "params": params, "single_ms": round(single * 1000, 2)}
+        result.update(flood(hasher, record, logins, slots))
+        output.append(result)
+    print(json.dumps(output, indent=2))
+
+
+if __name__ == "__main__":
+    main(*[int(each) for each in sys.argv[1:]])
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  lookups.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Point lookup latency before and after migrating the games table
+
+Usage: benchmarks/lookups.py [rows] [lookups]
+"""
+import sys
+import os
+import json
+import time
+import random
+import tempfile
+import sqlite3 as sql
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from schema import migrate
+
+
+def make_legacy_db(path, rows):
+    """Make a DB with the pre-migration schema and `rows' games"""
+    db = sql.connect(path)
+    db.execute("""CREATE TABLE games
+    (name TEXT, submitter TEXT, base64 BLOB, downloads INTEGER, genres TEXT, url BLOB,
+    screenshots_url BLOB, description TEXT, rating TEXT, platform TEXT,
+    add_time INTEGER, in_pack_man BOOLEAN)""")
+    db.executemany("INSERT INTO games VALUES (?, 'None', ?, 1, 'FPS,open-source', ?, '', ?, 'E', 'linux', 1623351659, 0)",
+                   (("game_%d" % (each), "YmFzZTY0XyVk%d" % (each), "https://example.com/%d" % (each),
+                     "Description of game %d" % (each)) for each in range(rows)))
+    db.commit()
+    return db
+
+
+def time_lookups(db, column, values):
+    """Get per-lookup latency, in microseconds, for WHERE `column' = ?"""
+    command = "SELECT * FROM games WHERE %s=?" % (column)
+    output = []
+    for each in values:
+        start = time.perf_counter()
+        db.execute(command, (each,)).fetchall()
+        output.append((time.perf_counter() - start) * 1000000)
+    output.sort()
+    return {"p50_us": round(output[len(output) // 2], 2),
+            "p99_us": round(output[int(len(output) * 0.99)], 2),
+            "mean_us": round(sum(output) / len(output), 2)}
+
+
+def main(rows=100000, lookups=500):
+    """Run the benchmark"""
+    picks = [random.randrange(rows) for each in range(lookups)]
+    names = ["game_%d" % (each) for each in picks]
+    base64_vals = ["YmFzZTY0XyVk%d" % (each) for each in picks]
+    with tempfile.TemporaryDirectory() as folder:
+        db = make_legacy_db(os.path.join(folder, "bench.sql"), rows)
+        output = {"rows": rows, "lookups": lookups,
+                  "before": {"name": time_lookups(db, "name", names),
+                             "base64": time_lookups(db, "base64", base64_vals)}}
+        start = time.perf_counter()
+        migrate(db)
+        output["migration_s"] = round(time.perf_counter() - start, 3)
+        output["after"] = {"name": time_lookups(db, "name", names),
+                           "base64": time_lookups(db, "base64", base64_vals)}
+        db.close()
+    print(json.dumps(output, indent=2))
+
+
+if __name__ == "__main__":
+    main(*[int(each) for each in sys.argv[1:]])
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  ratelimit.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Overhead and accuracy of the rate limiter
+
+Times a token lookup spread over `clients' clients, for the limiter's own
+overhead, and then has `workers' processes hammer one client's bucket for
+`seconds' seconds, to check that they let through no more than the bucket
+allows between them.
+
+Usage: benchmarks/ratelimit.py [clients] [workers] [seconds]
+"""
+import sys
+import os
+import json
+import time
+import shutil
+import tempfile
+import multiprocessing
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ratelimit import RateLimiter
+
+
+RATE = 50
+BURST = 100
+
+
+def percentiles(latencies):
+    """Get p50 and p99, in microseconds"""
+    latencies = sorted(latencies)
+    return {"p50_us": round(latencies[len(latencies) // 2] * 1000000, 1),
+            "p99_us": round(latencies[int(len(latencies) * 0.99)] * 1000000, 1)}
+
+
+def hammer(path, seconds, results):
+    """Take tokens from one bucket for `seconds' seconds, counting how many
+    were given
+    """
+    limiter = RateLimiter(path, {"rate": RATE, "burst": BURST})
+    allowed = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        if limiter.take("/search/<term>", "10.0.0.1") == 0:
+            allowed += 1
+    results.put(allowed)
+
+
+def main(clients=10000, workers=4, seconds=3):
+    folder = tempfile.mkdtemp(prefix="vetala-ratelimit-")
+    limiter = RateLimiter(os.path.join(folder, "overhead"), {"rate": RATE, "burst": BURST})
+    addresses = ["10.%d.%d.%d" % (each >> 16 & 255, each >> 8 & 255, each & 255) for each in range(clients)]
+    latencies = []
+    for each in range(100000):
+        address = addresses[each % clients]
+        start = time.perf_counter()
+        limiter.take("/search/<term>", address)
+        latencies.append(time.perf_counter() - start)
+    output = {"clients": clients, "take": percentiles(latencies)}
+    path = os.path.join(folder, "shared")
+    RateLimiter(path, {"rate": RATE, "burst": BURST})
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=hammer, args=(path, seconds, results))
+                 for each in range(workers)]
+    start = time.monotonic()
+    for each in processes:
+        each.start()
+    allowed = sum(results.get() for each in processes)
+    for each in processes:
+        each.join()
+    # The workers start at slightly different times, so allow for the longest run
+    output["shared"] = {"workers": workers, "allowed": allowed,
+                        "at_most": int(BURST + RATE * (time.monotonic() - start))}
+    shutil.rmtree(folder)
+    print(json.dumps(output, indent=2))
+
+
+if __name__ == "__main__":
+    main(*[int(each) for each in sys.argv[1:]])
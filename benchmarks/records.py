@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  records.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Memory and allocations of the catalog snapshot, with Game records against
+the old dict-of-dicts
+
+For each, reports the memory a snapshot keeps per game, how long building
+one takes, and what encoding /games and its name sort, and a slow free-text
+search, allocate at their peak.
+
+Usage: benchmarks/records.py [games]
+"""
+import sys
+import os
+import copy
+import json
+import time
+import random
+import tracemalloc
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from games import Game
+from catalog import keyed, encode_keyed, encode_json
+
+
+PRIVATE_FIELDS = ("URL", "base64", "in_pack_man", "submitter")
+WORDS = ["space", "arena", "quest", "dungeon", "racing", "classic", "open", "world", "tactical",
+         "pixel", "retro", "physics", "online", "story", "adventure", "castle", "robot"]
+
+
+def make_rows(games):
+    """Make rows of GAME_COLUMNS plus the id, like the catalog reads"""
+    rng = random.Random(1)
+    return [("game_%d" % (each), "None", "Z2FtZV8%d" % (each), rng.randrange(10000),
+             ",".join(rng.sample(WORDS, 3)), "https://example.com/%d.tar.gz" % (each),
+             "https://example.com/%d" % (each),
+             " ".join(rng.choice(WORDS) for word in range(20)), "e", "LINUX",
+             1600000000 + each, rng.random() < 0.2, each + 1) for each in range(games)]
+
+
+def format_data(to_format):
+    """How rows used to be turned into games"""
+    return_data = {}
+    length = 0
+    for data in to_format:
+        add = {"Name": data[0], "submitter": data[1], "base64": data[2],
+               "downloads": data[3], "genres": data[4].split(","),
+               "URL": data[5], "screenshots_url": data[6],
+               "description": data[7], "rating": data[8].upper(),
+               "platform": data[9].lower(), "joined": data[10],
+               "in_pack_man": data[11]}
+        return_data[length] = copy.deepcopy(add)
+        length += 1
+    return return_data
+
+
+class OldSnapshot:
+    """The views snapshots used to keep"""
+    def __init__(self, rows):
+        self.games = {}
+        self.by_name = {}
+        self.internal_by_name = {}
+        self.ids_by_name = {}
+        self.by_id = {}
+        for index, game in enumerate(format_data(rows).values()):
+            public = {key: value for key, value in game.items() if key not in PRIVATE_FIELDS}
+            self.games[index] = public
+            self.by_name[game["Name"]] = public
+            self.internal_by_name[game["Name"]] = game
+            self.ids_by_name[game["Name"]] = rows[index][-1]
+            self.by_id[rows[index][-1]] = public
+
+    def listing(self):
+        return encode_json(self.games)
+
+    def by_title(self):
+        ids = sorted(self.by_id, key=lambda each: self.by_id[each]["Name"].lower())
+        return encode_json({index: self.by_id[each] for index, each in enumerate(ids)})
+
+    def search(self, text):
+        return_data = {}
+        length = 0
+        data = copy.deepcopy(self.internal_by_name)
+        for game in data.values():
+            if text in game["Name"].lower() or text in game["description"].lower():
+                for each in PRIVATE_FIELDS:
+                    del game[each]
+                return_data[length] = game
+                length += 1
+        return return_data
+
+
+class NewSnapshot:
+    """The views snapshots keep now"""
+    def __init__(self, rows):
+        self.games = [Game.from_row(None, each) for each in rows]
+        self.by_name = {game.name: game for game in self.games}
+        self.by_id = {game.id: game for game in self.games}
+
+    def listing(self):
+        return encode_keyed(self.games)
+
+    def by_title(self):
+        return encode_keyed(sorted(self.games, key=lambda each: each.name.lower()))
+
+    def search(self, text):
+        return keyed([each for each in self.games
+                      if text in each.name.lower() or text in each.description.lower()])
+
+
+def peak(func):
+    """Get the peak memory `func' allocates, in bytes"""
+    tracemalloc.start()
+    func()
+    output = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return output
+
+
+def measure(kind, rows):
+    """Measure one kind of snapshot"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    snapshot = kind(rows)
+    kept = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    start = time.perf_counter()
+    kind(rows)
+    build = time.perf_counter() - start
+    return {"bytes_per_game": round(kept / len(rows), 1),
+            "build_ms": round(build * 1000, 2),
+            "games_peak_bytes": peak(snapshot.listing),
+            "name_sort_peak_bytes": peak(snapshot.by_title),
+            "search_peak_bytes": peak(lambda: snapshot.search("quest"))}
+
+
+def main(games=100000):
+    rows = make_rows(games)
+    print(json.dumps({"games": games, "dicts": measure(OldSnapshot, rows),
+                      "records": measure(NewSnapshot, rows)}, indent=2))
+
+
+if __name__ == "__main__":
+    main(*[int(each) for each in sys.argv[1:]])
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  suggest.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Latency of type-ahead suggestions, and the cost of keeping them current
+
+Builds the index over `games' synthetic games, then reports lookup latency
+for random 1 to 5 character prefixes the first time each is asked for and
+once cached, how long a sync with a round of downloads, new games and removed
+games takes, and the memory the index keeps.
+
+Usage: benchmarks/suggest.py [games] [lookups]
+"""
+import sys
+import os
+import json
+import time
+import random
+import tracemalloc
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from suggest import PrefixIndex
+
+
+SYLLABLES = ["ka", "zu", "mo", "ri", "tan", "vel", "or", "quest", "ar", "en", "dra", "gon",
+             "pix", "el", "star", "un", "der", "sea", "kart", "blob", "neo", "tux"]
+
+
+def make_name(rng):
+    """Make a game name of one to three made up words"""
+    return "_".join("".join(rng.choice(SYLLABLES) for each in range(rng.randint(1, 3))).title()
+                    for word in range(rng.randint(1, 3)))
+
+
+def make_weights(rng, games):
+    """Make the weights the catalog would pass for `games' games"""
+    weights = {}
+    while len(weights) < games:
+        weights[("game", make_name(rng) + "_%d" % (len(weights)))] = int(rng.paretovariate(1.2))
+    for each in range(200):
+        weights[("genre", "genre-%d" % (each))] = rng.randrange(1000000)
+    return weights
+
+
+def percentiles(latencies):
+    """Get p50 and p99, in microseconds"""
+    latencies = sorted(latencies)
+    return {"p50_us": round(latencies[len(latencies) // 2] * 1000000, 1),
+            "p99_us": round(latencies[int(len(latencies) * 0.99)] * 1000000, 1)}
+
+
+def lookups(index, prefixes):
+    """Time a lookup of every prefix"""
+    latencies = []
+    for each in prefixes:
+        start = time.perf_counter()
+        index.search(each, 10)
+        latencies.append(time.perf_counter() - start)
+    return percentiles(latencies)
+
+
+def main(games=100000, count=2000):
+    rng = random.Random(1)
+    weights = make_weights(rng, games)
+    tracemalloc.start()
+    index = PrefixIndex()
+    start = time.perf_counter()
+    index.sync(weights)
+    build = time.perf_counter() - start
+    kept = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    prefixes = [rng.choice(SYLLABLES + [make_name(rng).lower()])[:rng.randint(1, 5)]
+                for each in range(count)]
+    output = {"games": games, "build_s": round(build, 3),
+              "bytes_per_game": round(kept / games, 1),
+              "first": lookups(index, prefixes), "cached": lookups(index, prefixes)}
+    # A round of downloads, with a few games added and removed
+    entries = list(weights)
+    for each in rng.sample(entries, 500):
+        weights[each] += rng.randint(1, 50)
+    for each in rng.sample(entries, 20):
+        del weights[each]
+    for each in range(20):
+        weights[("game", make_name(rng) + "_new%d" % (each))] = rng.randrange(100)
+    start = time.perf_counter()
+    index.sync(weights)
+    output["sync_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    output["after_sync"] = lookups(index, prefixes)
+    print(json.dumps(output, indent=2))
+
+
+if __name__ == "__main__":
+    main(*[int(each) for each in sys.argv[1:]])
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  bulk.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Bulk changes to the catalog
+
+Imports and exports use the default_games.json format. Imports upsert on the download URL's base64, so re-running an import updates
+games instead of duplicating them, and are written with executemany() inside
+one transaction. Rows SQLite rejects, like a name another game already has,
+are found by retrying just their chunk one row at a time, and reported along
+with the records that failed validation, without holding up the rest.
+"""
+import sys
+import json
+import time
+import base64
+import sqlite3 as sql
+from catalog import bump_generation, encode_json
+from schema import GAME_COLUMNS, tag_rows
+from games import COLUMNS, RESERVED_NAMES, select_games
+
+
+# RETURNING needs SQLite 3.35 or newer
+HAS_RETURNING = sql.sqlite_version_info >= (3, 35, 0)
+# Records are upserted this many at a time, so one bad row only costs
+# retrying its own chunk
+CHUNK_SIZE = 500
+# Fields every imported record needs
+REQUIRED = ("Name", "URL", "platform", "genres")
+# Text fields that may be left out
+OPTIONAL_TEXT = ("description", "screenshots_url", "submitter")
+# Downloads and join times are the store's own, so updates leave them be
+UPSERT = """INSERT INTO games (%s) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (base64) DO UPDATE SET name=excluded.name, genres=excluded.genres,
+url=excluded.url, screenshots_url=excluded.screenshots_url,
+description=excluded.description, rating=excluded.rating,
+platform=excluded.platform, in_pack_man=excluded.in_pack_man""" % (GAME_COLUMNS)
+
+
+def url_base64(url):
+    """Get the base64 key for a download URL, the way add_game makes it"""
+    return base64.encodebytes(url.encode()).decode().strip("\r").strip("\n")
+
+
+def read_games(stream):
+    """Read records from a file of JSON or NDJSON
+
+    JSON can be an object of records, like default_games.json, or a list of
+    them. Yields (position, record) pairs. Lines of NDJSON that don't parse
+    are yielded as a ValueError in place of the record.
+    """
+    text = stream.read()
+    if isinstance(text, bytes):
+        text = text.decode()
+    try:
+        data = json.loads(text)
+    except ValueError:
+        data = None
+    if isinstance(data, dict):
+        data = list(data.values())
+    if isinstance(data, list):
+        yield from enumerate(data)
+        return
+    position = 0
+    for line in text.splitlines():
+        if line.strip() == "":
+            continue
+        try:
+            yield position, json.loads(line)
+        except ValueError as error:
+            yield position, ValueError("Invalid JSON: %s" % (error))
+        position += 1
+
+
+def validate(record, submitter="None"):
+    """Turn a record into a row of GAME_COLUMNS
+
+    Raises ValueError describing the first problem found.
+    """
+    if isinstance(record, ValueError):
+        raise record
+    if not isinstance(record, dict):
+        raise ValueError("Expected an object")
+    for each in REQUIRED:
+        if record.get(each) in (None, "", []):
+            raise ValueError("Missing field: %s" % (each))
+    for each in ("Name", "URL", "platform", "base64") + OPTIONAL_TEXT:
+        if not isinstance(record.get(each, ""), str):
+            raise ValueError("Field must be text: %s" % (each))
+    genres = record["genres"]
+    if isinstance(genres, list):
+        if not all(isinstance(each, str) and "," not in each for each in genres):
+            raise ValueError("Genres must be text, without commas")
+        genres = ",".join(genres)
+    elif not isinstance(genres, str):
+        raise ValueError("Genres must be a list or comma delimited text")
+    rating = record.get("rating")
+    if rating is not None and not isinstance(rating, str):
+        raise ValueError("Field must be text: rating")
+    for each in ("downloads", "joined"):
+        value = record.get(each, 0)
+        if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+            raise ValueError("Field must be a positive number: %s" % (each))
+    if not isinstance(record.get("in_pack_man", False), bool):
+        raise ValueError("Field must be true or false: in_pack_man")
+    name = record["Name"].replace(" ", "_")
+    if name in RESERVED_NAMES:
+        raise ValueError("Name is reserved: %s" % (name))
+    # A missing rating has always been stored as the string "None"
+    return (name, record.get("submitter", submitter),
+            record.get("base64") or url_base64(record["URL"]), record.get("downloads", 0),
+            genres, record["URL"], record.get("screenshots_url", ""),
+            record.get("description", ""), str(rating).upper(), record["platform"].lower(),
+            record.get("joined") or int(time.time()), record.get("in_pack_man", False))
+
+
+def _upsert(db, chunk, errors):
+    """Upsert a chunk of (position, row) pairs
+
+    Returns the base64 values of the rows that made it in. Rows that fail are
+    added to `errors'.
+    """
+    db.execute("SAVEPOINT bulk_chunk")
+    try:
+        db.executemany(UPSERT, [each[1] for each in chunk])
+        db.execute("RELEASE bulk_chunk")
+        return [each[1][2] for each in chunk]
+    except sql.IntegrityError:
+        db.execute("ROLLBACK TO bulk_chunk")
+        db.execute("RELEASE bulk_chunk")
+    added = []
+    for position, row in chunk:
+        try:
+            db.execute(UPSERT, row)
+            added.append(row[2])
+        except sql.IntegrityError as error:
+            errors.append({"record": position, "Name": row[0], "error": str(error)})
+    return added
+
+
+def _reindex_tags(db, base64_vals):
+    """Rebuild the tag index entries of the given games"""
+    rows = db.execute("""SELECT id, genres, rating, platform FROM games
+    WHERE base64 IN (%s)""" % (", ".join(["?"] * len(base64_vals))), base64_vals).fetchall()
+    db.executemany("DELETE FROM game_tags WHERE game_id = ?", [(each[0],) for each in rows])
+    db.executemany("INSERT OR IGNORE INTO game_tags VALUES (?, ?, ?)",
+                   [tag for each in rows for tag in tag_rows(*each)])
+
+
+def _write(database, batch, errors):
+    """Upsert a batch of (position, row) pairs in one transaction
+
+    Returns how many were imported.
+    """
+    imported = 0
+    with database.transaction() as db:
+        for start in range(0, len(batch), CHUNK_SIZE):
+            added = _upsert(db, batch[start:start + CHUNK_SIZE], errors)
+            if added != []:
+                _reindex_tags(db, added)
+            imported += len(added)
+        bump_generation(db)
+    return imported
+
+
+def _commit(database, batch, report, next_position):
+    """Write a batch, and update the report. Returns False if it failed."""
+    if batch == []:
+        report["next"] = next_position
+        return True
+    try:
+        errors = []
+        report["imported"] += _write(database, batch, errors)
+        report["errors"].extend(errors)
+    except sql.Error as error:
+        print("Bulk import stopped: %s" % (error), file=sys.stderr)
+        report["error"] = "Import stopped: %s" % (error)
+        return False
+    report["next"] = next_position
+    return True
+
+
+def import_games(database, records, submitter="None", resume=0, batch_size=0):
+    """Validate and upsert (position, record) pairs from read_games()
+
+    Records before position `resume' are skipped. Everything is written in
+    one transaction, unless `batch_size' is set, in which case every
+    `batch_size' records are committed on their own, so an interrupted
+    import can be picked up again from the report's "next" position.
+
+    Returns a report of how many games were imported, the records that
+    failed and why, and the position to resume from.
+    """
+    report = {"imported": 0, "errors": [], "next": resume}
+    batch = []
+    last = resume - 1
+    for position, record in records:
+        if position < resume:
+            continue
+        last = position
+        try:
+            batch.append((position, validate(record, submitter)))
+        except ValueError as error:
+            name = record.get("Name") if isinstance(record, dict) else None
+            report["errors"].append({"record": position, "Name": name, "error": str(error)})
+        if batch_size > 0 and len(batch) >= batch_size:
+            if not _commit(database, batch, report, position + 1):
+                report["errors"].sort(key=lambda each: each["record"])
+                return report
+            batch = []
+    _commit(database, batch, report, last + 1)
+    report["errors"].sort(key=lambda each: each["record"])
+    return report
+
+
+def export_records(db, chunk_size=500, ndjson=True):
+    """Stream every game, with its private fields, in the import format
+
+    Yields NDJSON, or the chunks of one default_games.json style object.
+    `db' is closed once the export is done or abandoned.
+    """
+    try:
+        db.execute("BEGIN DEFERRED")
+        cursor = select_games(db, "SELECT %s FROM games ORDER BY id" % (COLUMNS))
+        position = 0
+        if not ndjson:
+            yield b"{"
+        while True:
+            games = cursor.fetchmany(chunk_size)
+            if games == []:
+                break
+            output = []
+            for game in games:
+                record = encode_json(game.record())
+                if ndjson:
+                    output.append(record + b"\n")
+                else:
+                    output.append(b"%s\"%d\":%s" % (b"," if position > 0 else b"", position, record))
+                position += 1
+            yield b"".join(output)
+        if not ndjson:
+            yield b"}"
+    finally:
+        db.close()
+
+
+def delete_games(db, base64_vals, submitter=None):
+    """Delete the games with the given base64 values, in as few statements as
+    possible
+
+    If `submitter' is given, only their games are deleted. Returns the names
+    of the deleted games. Call this inside a transaction.
+    """
+    deleted = []
+    base64_vals = list(dict.fromkeys(base64_vals))
+    scope, params = "", []
+    if submitter is not None:
+        scope, params = " AND submitter = ?", [submitter]
+    for start in range(0, len(base64_vals), CHUNK_SIZE):
+        chunk = base64_vals[start:start + CHUNK_SIZE]
+        where = "base64 IN (%s)%s" % (", ".join(["?"] * len(chunk)), scope)
+        if HAS_RETURNING:
+            deleted.extend([each[0] for each in
+                            db.execute("DELETE FROM games WHERE %s RETURNING name" % (where),
+                                       chunk + params).fetchall()])
+        else:
+            deleted.extend([each[0] for each in
+                            db.execute("SELECT name FROM games WHERE %s" % (where),
+                                       chunk + params).fetchall()])
+            db.execute("DELETE FROM games WHERE %s" % (where), chunk + params)
+    return deleted
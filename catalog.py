@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  catalog.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""In-process, read-mostly snapshot of the game catalog
+
+Each worker keeps one snapshot of the games table, tagged with the generation
+counter stored in the DB. Anything that changes the games table bumps that
+counter in the same transaction, so every worker notices the write the next
+time it checks the counter and rebuilds its snapshot.
+
+Download count flushes bump a counter of their own instead. A worker that
+sees only that one move reads the counts of the games that changed, from the
+change log, and patches them into a copy of its snapshot, keeping everything
+else, including the encoded bodies that don't show download counts.
+"""
+import io
+import copy
+import bisect
+import gzip
+import hashlib
+import json
+import threading
+import time
+from games import COLUMNS, select_games
+from rankings import Ranking, popularity_key, recency_key, top_decayed
+from search_index import tag_counts
+from suggest import PrefixIndex, catalog_weights, download_changes
+from changes import Resync, latest_change, changed_downloads
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Every content coding gets its own strong ETag, since the bytes differ
+CODING_SUFFIXES = {"identity": "", "gzip": ".gz", "br": ".br"}
+# Compression levels, traded towards speed, since a body is compressed inside
+# the first request asking for that coding: gzip 9 takes seconds on a large
+# /games, and brotli's default quality of 11 far longer
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 5
+# Keys of bodies that don't show download counts, kept when only those change
+COUNT_FREE = ("tags",)
+
+
+def get_generation(db):
+    """Get the current catalog generation"""
+    row = db.execute("SELECT value FROM catalog_meta WHERE key='generation'").fetchone()
+    if row is None:
+        return 0
+    return row[0]
+
+
+def get_versions(db):
+    """Get the current catalog generation and download count version"""
+    versions = dict(db.execute("""SELECT key, value FROM catalog_meta
+    WHERE key IN ('generation', 'downloads')""").fetchall())
+    return versions.get("generation", 0), versions.get("downloads", 0)
+
+
+def bump_downloads(db):
+    """Mark download counts as changed, leaving the generation be
+
+    Call this inside the same transaction as the counts it covers.
+    """
+    db.execute("UPDATE catalog_meta SET value = value + 1 WHERE key='downloads'")
+
+
+def bump_generation(db):
+    """Mark the catalog as changed
+
+    Call this inside the same transaction as the write it covers.
+    """
+    db.execute("UPDATE catalog_meta SET value = value + 1 WHERE key='generation'")
+
+
+def encode_json(data):
+    """Encode response data the way the API always has"""
+    return json.dumps(data, sort_keys=True, separators=(",", ":")).encode()
+
+
+class EncodedBody:
+    """A JSON response body, encoded once and compressed on demand
+
+    `data' may also be JSON that is already encoded, as bytes.
+    """
+    def __init__(self, data):
+        if not isinstance(data, bytes):
+            data = encode_json(data)
+        self._bodies = {"identity": data}
+
+    def body(self, coding):
+        """Get the body in the given content coding"""
+        if coding not in self._bodies:
+            if coding == "gzip":
+                self._bodies[coding] = gzip.compress(self._bodies["identity"], GZIP_LEVEL)
+            elif coding == "br":
+                self._bodies[coding] = brotli.compress(self._bodies["identity"], quality=BROTLI_QUALITY)
+        return self._bodies[coding]
+
+
+def make_etag(version, key):
+    """Get the ETag for `key' at the given catalog version"""
+    digest = hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+    return "v%s.%s" % (version, digest)
+
+
+def searched_fields(game):
+    """Get the fields of a game that searches look at"""
+    return (game.id, game.name, game.description, game.genres, game.rating, game.platform)
+
+
+def keyed(games):
+    """Get the public fields of games, keyed by position like /games"""
+    return {index: game.public() for index, game in enumerate(games)}
+
+
+def encode_keyed(games, snippets=None):
+    """Encode the public fields of games, keyed by position like /games
+
+    Gives the same bytes as encode_json(keyed(games)), from the encoding
+    each Game keeps of itself. `snippets' may give a free-text snippet, or
+    None, for each game.
+    """
+    if snippets is None:
+        snippets = [None] * len(games)
+    output = io.BytesIO()
+    output.write(b"{")
+    for index, (game, snippet) in enumerate(zip(games, snippets)):
+        output.write(b'%s"%d":%s' % (b"," if index > 0 else b"", index, game.public_json(snippet)))
+    output.write(b"}")
+    return output.getvalue()
+
+
+class CatalogSnapshot:
+    """Prebuilt views of the catalog at a given generation and download
+    count version
+
+    `games' is every Game, in table order, as of change log event
+    `change_seq'.
+    """
+    def __init__(self, generation, games, counts, stats=None, change_seq=0, downloads=0):
+        self.generation = generation
+        self.downloads = downloads
+        # Everything a body can show
+        self.version = (generation, downloads)
+        self.change_seq = change_seq
+        # Only changes when a change to the catalog could change search results
+        self.search_version = generation
+        self.stats = {"hit": 0, "miss": 0} if stats is None else stats
+        self.games = games
+        self.by_name = {game.name: game for game in games}
+        self.by_id = {game.id: game for game in games}
+        self._ids = [game.id for game in games]
+        # Filled in by the Catalog, from its rankings
+        self.orders = {}
+        self.tags = {kind: list(counts[kind]) for kind in counts}
+        self.tags["counts"] = counts
+        self._encoded = {}
+
+    def ranked(self, order, count=None):
+        """Get games in the given order, encoded like /games"""
+        if order == "name":
+            games = sorted(self.games, key=lambda each: each.name.lower())
+        else:
+            games = [self.by_id[each] for each in self.orders[order]]
+        if count is not None:
+            games = games[:count]
+        return encode_keyed(games)
+
+    def decayed(self, count):
+        """Get the most popular games, with older downloads counting less"""
+        ids = top_decayed(((game.id, game.downloads, game.joined) for game in self.games), count)
+        return encode_keyed([self.by_id[each] for each in ids])
+
+    def etag(self, key):
+        """Get the ETag, without content coding, for `key' in this snapshot"""
+        if key in COUNT_FREE:
+            return make_etag(self.generation, key)
+        return make_etag("%d.%d" % self.version, key)
+
+    def recounted(self, downloads, counts, change_seq):
+        """Get a copy of this snapshot with new download counts
+
+        `counts' is a dict of game ID to download count, for at least every
+        game whose count changed. The copy shares every other game, and the
+        bodies that don't show download counts, with this snapshot. Returns
+        the copy, and (old Game, new Game) pairs for the games that changed.
+        """
+        snapshot = copy.copy(self)
+        snapshot.downloads = downloads
+        snapshot.version = (self.generation, downloads)
+        snapshot.change_seq = change_seq
+        snapshot.games = list(self.games)
+        snapshot.by_id = dict(self.by_id)
+        snapshot.by_name = dict(self.by_name)
+        snapshot.orders = {}
+        snapshot._encoded = {key: body for key, body in self._encoded.items() if key in COUNT_FREE}
+        changed = []
+        for game_id, count in counts.items():
+            old = self.by_id.get(game_id)
+            if old is None or old.downloads == count:
+                continue
+            game = old.with_downloads(count)
+            snapshot.games[bisect.bisect_left(self._ids, game_id)] = game
+            snapshot.by_id[game_id] = game
+            snapshot.by_name[game.name] = game
+            changed.append((old, game))
+        return snapshot, changed
+
+    def encoded(self, key, build, cache=True):
+        """Get the encoded response for `key'
+
+        `build' is only called when the body is not already cached, and may
+        return an EncodedBody cached elsewhere. Pass cache=False for keys that
+        should not live as long as the snapshot.
+        """
+        body = self._encoded.get(key)
+        if body is None:
+            self.stats["miss"] += 1
+            body = build()
+            if not isinstance(body, EncodedBody):
+                body = EncodedBody(body)
+            if cache:
+                body = self._encoded.setdefault(key, body)
+        else:
+            self.stats["hit"] += 1
+        return body
+
+
+class Catalog:
+    """Per-worker catalog cache
+
+    `database' is the worker's Database. The DB is checked for writes from
+    other workers at most once every `check_interval' seconds. At most
+    `suggestion_size' suggestions are kept for any prefix.
+    """
+    def __init__(self, database, check_interval=1.0, suggestion_size=20):
+        self.database = database
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._checked = 0
+        self._lock = threading.Lock()
+        self.stats = {"snapshot_hit": 0, "snapshot_miss": 0}
+        self._encoded_stats = {"hit": 0, "miss": 0}
+        # Kept across snapshots, so a rebuild only moves the games that changed
+        self.rankings = {"popular": (Ranking(), popularity_key),
+                         "new": (Ranking(), recency_key)}
+        # Built the first time someone asks for suggestions, then kept in step
+        self.suggestions = PrefixIndex(suggestion_size)
+        self._suggesting = False
+
+    def get_stats(self):
+        """Get the cache counts
+
+        Snapshot reads that needed no rebuild are "snapshot_hit", and those
+        that did "snapshot_miss". Encoded body lookups are "encoded_hit" and
+        "encoded_miss". Counts are not locked, so under load they can be off
+        by a little.
+        """
+        stats = dict(self.stats)
+        stats["encoded_hit"] = self._encoded_stats["hit"]
+        stats["encoded_miss"] = self._encoded_stats["miss"]
+        return stats
+
+    def invalidate(self):
+        """Force a generation check on the next read"""
+        self._checked = 0
+
+    def get(self):
+        """Get an up-to-date catalog snapshot"""
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - self._checked < self.check_interval:
+            self.stats["snapshot_hit"] += 1
+            return snapshot
+        with self._lock:
+            # Someone else may have refreshed while we waited
+            if self._snapshot is not snapshot and time.monotonic() - self._checked < self.check_interval:
+                self.stats["snapshot_hit"] += 1
+                return self._snapshot
+            generation, downloads = get_versions(self.database.get())
+            if self._snapshot is None or self._snapshot.generation != generation:
+                self.stats["snapshot_miss"] += 1
+                self._snapshot = self._build()
+            elif self._snapshot.downloads != downloads:
+                self.stats["snapshot_miss"] += 1
+                self._snapshot = self._recount()
+            else:
+                self.stats["snapshot_hit"] += 1
+            self._checked = time.monotonic()
+            return self._snapshot
+
+    def _build(self):
+        """Read the whole catalog in one read transaction"""
+        with self.database.transaction("DEFERRED") as db:
+            generation, downloads = get_versions(db)
+            games = select_games(db, "SELECT %s FROM games ORDER BY id" % (COLUMNS)).fetchall()
+            counts = tag_counts(db)
+            change_seq = latest_change(db)
+        snapshot = CatalogSnapshot(generation, games, counts, stats=self._encoded_stats,
+                                   change_seq=change_seq, downloads=downloads)
+        previous = self._snapshot
+        if (previous is not None and len(previous.games) == len(games) and
+                all(searched_fields(old) == searched_fields(new) for old, new in zip(previous.games, games))):
+            snapshot.search_version = previous.search_version
+        for order, (ranking, key) in self.rankings.items():
+            ranking.sync({game.id: key(game.downloads, game.joined) for game in games})
+            snapshot.orders[order] = ranking.ids()
+        if self._suggesting:
+            self.suggestions.sync(catalog_weights(games))
+        return snapshot
+
+    def _recount(self):
+        """Bring the snapshot's download counts up to date, reading only the
+        games the change log says have changed since it was made
+
+        Falls back to reading every count if the log doesn't go back that
+        far, and to a full rebuild if the catalog itself has changed since.
+        """
+        previous = self._snapshot
+        with self.database.transaction("DEFERRED") as db:
+            generation, downloads = get_versions(db)
+            if generation != previous.generation:
+                counts = None
+            else:
+                change_seq = latest_change(db)
+                try:
+                    counts = changed_downloads(db, previous.change_seq, change_seq)
+                except Resync:
+                    counts = dict(db.execute("SELECT id, downloads FROM games").fetchall())
+        if counts is None:
+            return self._build()
+        snapshot, changed = previous.recounted(downloads, counts, change_seq)
+        for order, (ranking, key) in self.rankings.items():
+            for old, game in changed:
+                ranking.update(game.id, key(game.downloads, game.joined))
+            snapshot.orders[order] = ranking.ids()
+        if self._suggesting:
+            self.suggestions.add(download_changes(changed))
+        return snapshot
+
+    def suggest(self, prefix, count=None):
+        """Get the best (kind, label, downloads) matches for `prefix' among
+        game names and tags
+        """
+        self.get()
+        if not self._suggesting:
+            with self._lock:
+                if not self._suggesting:
+                    self.suggestions.sync(catalog_weights(self._snapshot.games))
+                    self._suggesting = True
+        return self.suggestions.search(prefix, count)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  changes.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Change log of the games table, for clients syncing the catalog
+
+Triggers on the games table append an event to game_changes for every insert,
+update and delete, whoever makes it: the admin pages, bulk imports and
+download count flushes alike. Every event gets the next sequence number, and
+only the newest `change_log_size' events are kept, so a client that last
+synced before the oldest one has to fetch the whole catalog again.
+"""
+
+
+class Resync(Exception):
+    """The change log no longer goes back far enough"""
+
+
+def latest_change(db):
+    """Get the sequence number of the newest event, or 0 if there are none"""
+    row = db.execute("SELECT seq FROM sqlite_sequence WHERE name='game_changes'").fetchone()
+    if row is None:
+        return 0
+    return row[0]
+
+
+def set_log_size(db, size):
+    """Set how many events to keep, taking effect from the next change"""
+    db.execute("UPDATE catalog_meta SET value = ? WHERE key='change_log_size'", (max(int(size), 1),))
+
+
+def _check_since(db, since):
+    """Raise Resync unless the log has every event after `since'"""
+    oldest = db.execute("SELECT MIN(seq) FROM game_changes").fetchone()[0]
+    latest = latest_change(db)
+    if oldest is None:
+        oldest = latest + 1
+    if since > latest:
+        raise Resync("Ahead of the change log, which may have been restored from a backup. "
+                     "Fetch /games again.")
+    if since < oldest - 1:
+        raise Resync("Too far behind to sync. Fetch /games again.")
+
+
+def changes_since(db, since, until):
+    """Get what changed after event `since', up to and including event `until'
+
+    Returns the IDs of the games that changed, and every name that a game
+    went by in those events, so names that were removed or renamed away can
+    be told apart from current ones. Raises Resync if events after `since'
+    have already been dropped, or if `since' is newer than the log. Run it
+    in a read transaction, so nothing is dropped halfway through.
+    """
+    _check_since(db, since)
+    ids = set()
+    names = set()
+    for game_id, name in db.execute("""SELECT game_id, name FROM game_changes
+    WHERE seq > ? AND seq <= ?""", (since, until)):
+        ids.add(game_id)
+        names.add(name)
+    return ids, names
+
+
+def changed_downloads(db, since, until):
+    """Get the download counts of the games that changed after event
+    `since', up to and including event `until', as a dict of game ID to count
+
+    Raises Resync like changes_since() does.
+    """
+    _check_since(db, since)
+    return dict(db.execute("""SELECT id, downloads FROM games WHERE id IN
+    (SELECT game_id FROM game_changes WHERE seq > ? AND seq <= ?)""", (since, until)).fetchall())
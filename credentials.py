@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  credentials.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Admin account storage
+
+Both stores hold one record per user: a dict with the user's password hash,
+how it was made (see passwords.py) and their removable flag. Records handed
+out are copies, so changing one does nothing until it is written back with
+update_user().
+"""
+import os
+import copy
+import json
+import fcntl
+import tempfile
+import threading
+import contextlib
+from database import Database
+
+
+def _apply(record, changes):
+    """Apply update_user() changes to a record"""
+    for field, value in changes.items():
+        if value is None:
+            record.pop(field, None)
+        else:
+            record[field] = value
+
+
+class JSONCredentialStore:
+    """Accounts kept in the secrets file, next to its non-account settings
+
+    The parsed file is cached, and only re-read when its inode, size or
+    modification time change. Writes take an exclusive lock on a lock file
+    next to it, re-read it, and replace it atomically with a rename, so
+    concurrent writers from different workers never lose each other's
+    changes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._cache = None
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """Get the parsed secrets file, from the cache if it is still current"""
+        stat = os.stat(self.path)
+        stamp = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        cache = self._cache
+        if cache is not None and self._stamp == stamp:
+            return cache
+        with open(self.path, "r") as file:
+            cache = json.load(file)
+        with self._lock:
+            self._cache = cache
+            self._stamp = stamp
+        return cache
+
+    @contextlib.contextmanager
+    def _modify(self):
+        """Yield a fresh, mutable copy of the secrets file, and write it back"""
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                original = self._load()
+                secrets = copy.deepcopy(original)
+                yield secrets
+                if secrets == original:
+                    return
+                folder = os.path.dirname(os.path.abspath(self.path))
+                handle, temp = tempfile.mkstemp(dir=folder, prefix=".auth-")
+                try:
+                    with os.fdopen(handle, "w") as file:
+                        json.dump(secrets, file, indent=2)
+                        file.flush()
+                        os.fsync(file.fileno())
+                    os.chmod(temp, os.stat(self.path).st_mode & 0o777)
+                    os.replace(temp, self.path)
+                except BaseException:
+                    if os.path.exists(temp):
+                        os.remove(temp)
+                    raise
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def get(self, key, default=None):
+        """Get one of the non-account settings, like the secret key"""
+        return copy.deepcopy(self._load().get(key, default))
+
+    def setdefault(self, key, default):
+        """Get one of the non-account settings, saving `default' for it first
+        if it is missing or empty
+        """
+        value = self._load().get(key)
+        if value not in (None, ""):
+            return copy.deepcopy(value)
+        with self._modify() as secrets:
+            # Someone may have beaten us to it while we waited for the lock
+            if secrets.get(key) in (None, ""):
+                secrets[key] = default
+            value = secrets[key]
+        return copy.deepcopy(value)
+
+    def users(self):
+        """Get every account, as a dict of username to record"""
+        secrets = self._load()
+        return {each: dict(secrets[each]) for each in secrets if isinstance(secrets[each], dict)}
+
+    def get_user(self, username):
+        """Get one account's record, or None"""
+        record = self._load().get(username)
+        if not isinstance(record, dict):
+            return None
+        return dict(record)
+
+    def add_user(self, username, record):
+        """Add an account. Returns False if the username is taken."""
+        with self._modify() as secrets:
+            if username in secrets:
+                return False
+            secrets[username] = record
+        return True
+
+    def update_user(self, username, **changes):
+        """Change some fields of an account, removing those set to None.
+        Returns False if it is missing.
+        """
+        with self._modify() as secrets:
+            if not isinstance(secrets.get(username), dict):
+                return False
+            _apply(secrets[username], changes)
+        return True
+
+    def remove_user(self, username):
+        """Remove an account. Returns False if it is missing."""
+        with self._modify() as secrets:
+            if not isinstance(secrets.get(username), dict):
+                return False
+            del secrets[username]
+        return True
+
+
+class SQLiteCredentialStore:
+    """Accounts kept in their own SQLite DB
+
+    Non-account settings stay in the secrets file. The first time the DB is
+    created, the accounts from the secrets file are copied into it.
+    """
+    def __init__(self, path, secrets_file):
+        self.secrets = JSONCredentialStore(secrets_file)
+        self.database = Database(path)
+        with self.database.transaction() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS users
+            (username TEXT PRIMARY KEY, record TEXT NOT NULL)""")
+            if db.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0:
+                db.executemany("INSERT INTO users VALUES (?, ?)",
+                               [(each, json.dumps(record)) for each, record in self.secrets.users().items()])
+
+    def get(self, key, default=None):
+        """Get one of the non-account settings, like the secret key"""
+        return self.secrets.get(key, default)
+
+    def setdefault(self, key, default):
+        """Get one of the non-account settings, saving `default' for it first
+        if it is missing or empty
+        """
+        return self.secrets.setdefault(key, default)
+
+    def users(self):
+        """Get every account, as a dict of username to record"""
+        return {each: json.loads(record) for each, record in
+                self.database.get().execute("SELECT username, record FROM users ORDER BY rowid")}
+
+    def get_user(self, username):
+        """Get one account's record, or None"""
+        row = self.database.get().execute("SELECT record FROM users WHERE username=?",
+                                          (username,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def add_user(self, username, record):
+        """Add an account. Returns False if the username is taken."""
+        with self.database.transaction() as db:
+            return db.execute("INSERT OR IGNORE INTO users VALUES (?, ?)",
+                              (username, json.dumps(record))).rowcount == 1
+
+    def update_user(self, username, **changes):
+        """Change some fields of an account, removing those set to None.
+        Returns False if it is missing.
+        """
+        with self.database.transaction() as db:
+            row = db.execute("SELECT record FROM users WHERE username=?", (username,)).fetchone()
+            if row is None:
+                return False
+            record = json.loads(row[0])
+            _apply(record, changes)
+            db.execute("UPDATE users SET record=? WHERE username=?", (json.dumps(record), username))
+        return True
+
+    def remove_user(self, username):
+        """Remove an account. Returns False if it is missing."""
+        with self.database.transaction() as db:
+            return db.execute("DELETE FROM users WHERE username=?", (username,)).rowcount == 1
+
+
+def open_store(settings):
+    """Get the credential store configured in settings.json"""
+    if settings.get("credential_store", "json") == "sqlite":
+        return SQLiteCredentialStore(settings.get("credential_db", "auth.sql"),
+                                     settings["secrets_file"])
+    return JSONCredentialStore(settings["secrets_file"])
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  database.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Persistent, per-thread SQLite connections
+
+Every thread of every worker process gets one connection, opened on first
+use and kept open until the worker exits. Connections are opened in WAL
+mode, so readers never wait on the admin writes, and in autocommit mode, so
+writes have to go through Database.transaction().
+"""
+import os
+import time
+import atexit
+import threading
+import contextlib
+import sqlite3 as sql
+
+
+# Default tuning, overridable through the "sqlite" object in settings.json
+DEFAULTS = {"synchronous": "NORMAL",
+            "mmap_size": 268435456,
+            "cache_size": -16384,
+            "busy_timeout": 5000,
+            "cached_statements": 256}
+
+
+class TimedConnection(sql.Connection):
+    """A connection that reports how long each statement takes to on_query()"""
+    @staticmethod
+    def on_query(seconds):
+        """Replaced with the Database's on_query once the connection is tuned"""
+
+    def execute(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            self.on_query(time.perf_counter() - start)
+
+    def executemany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            self.on_query(time.perf_counter() - start)
+
+
+class Database:
+    """Per-thread connection manager for one DB file
+
+    If `on_query' is given, it is called with the time every statement run
+    through a connection's execute() or executemany() took.
+    """
+    def __init__(self, path, on_query=None, **options):
+        self.path = path
+        self.on_query = on_query
+        self.options = dict(DEFAULTS, **options)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._pid = os.getpid()
+        atexit.register(self.close)
+
+    def open(self):
+        """Open and tune a new connection, that the caller has to close
+
+        Use this for long-running reads that should not tie up this thread's
+        shared connection.
+        """
+        db = sql.connect(self.path, isolation_level=None, check_same_thread=False,
+                         cached_statements=self.options["cached_statements"],
+                         factory=sql.Connection if self.on_query is None else TimedConnection)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=%s" % (self.options["synchronous"]))
+        db.execute("PRAGMA mmap_size=%d" % (self.options["mmap_size"]))
+        db.execute("PRAGMA cache_size=%d" % (self.options["cache_size"]))
+        db.execute("PRAGMA busy_timeout=%d" % (self.options["busy_timeout"]))
+        if self.on_query is not None:
+            db.on_query = self.on_query
+        return db
+
+    def _check_fork(self):
+        """Forget connections inherited from the parent process
+
+        SQLite connections must never be used, or even closed, on both sides
+        of a fork. The parent's connections are left for it to deal with.
+        """
+        if os.getpid() != self._pid:
+            with self._lock:
+                if os.getpid() != self._pid:
+                    self._local = threading.local()
+                    self._connections = []
+                    self._pid = os.getpid()
+
+    def get(self):
+        """Get this thread's connection"""
+        self._check_fork()
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self.open()
+            self._local.db = db
+            with self._lock:
+                self._connections.append(db)
+        return db
+
+    @contextlib.contextmanager
+    def transaction(self, mode="IMMEDIATE"):
+        """Run a block in a transaction, committing unless it raises
+
+        IMMEDIATE transactions take the write lock up front, so two writers
+        never deadlock upgrading their read locks. Use mode="DEFERRED" for a
+        consistent read.
+        """
+        db = self.get()
+        db.execute("BEGIN %s" % (mode))
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def close(self):
+        """Close every connection this process opened"""
+        self._check_fork()
+        with self._lock:
+            for each in self._connections:
+                try:
+                    each.close()
+                except sql.Error:
+                    pass
+            self._connections = []
+            self._local = threading.local()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  downloads.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Batched download counting
+
+Downloads are counted in memory and a background thread in each worker adds
+them to the DB every so often, in one transaction, so the download endpoint
+never waits on the write lock. Read-only replicas forward their counts to the
+primary instead, which adds them to its own.
+"""
+import sys
+import json
+import atexit
+import threading
+import sqlite3 as sql
+import urllib.request
+from catalog import bump_downloads
+from workers import PerProcess
+
+
+class DownloadCounter:
+    """Per-worker download counts, flushed every `interval' seconds"""
+    def __init__(self, database, interval=5.0, on_flush=None):
+        self.database = database
+        self.interval = interval
+        self.on_flush = on_flush
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._start = PerProcess(self._start_thread, self._lock)
+        atexit.register(self.stop)
+
+    def _start_thread(self):
+        """Start this worker's flusher thread, the first time it counts a
+        download
+        """
+        # Anything counted before the fork was the parent's to flush
+        self._pending = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="download-flusher", daemon=True)
+        self._thread.start()
+
+    def record(self, game_id):
+        """Count a download of a game"""
+        self.add({game_id: 1})
+
+    def add(self, counts):
+        """Count downloads of several games, as a dict of game ID to count"""
+        self._start()
+        with self._lock:
+            for game_id, count in counts.items():
+                self._pending[game_id] = self._pending.get(game_id, 0) + count
+
+    def _write(self, pending):
+        """Add counts to the DB"""
+        with self.database.transaction() as db:
+            db.executemany("UPDATE games SET downloads = downloads + ? WHERE id = ?",
+                           [(count, game_id) for game_id, count in pending.items()])
+            bump_downloads(db)
+
+    def flush(self):
+        """Add the pending counts to the DB"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if pending == {}:
+            return
+        try:
+            self._write(pending)
+        except (sql.Error, OSError) as error:
+            print("Could not flush download counts: %s" % (error), file=sys.stderr)
+            # Keep them for the next try
+            with self._lock:
+                for game_id, count in pending.items():
+                    self._pending[game_id] = self._pending.get(game_id, 0) + count
+            return
+        except Exception as error:
+            # Retrying would only fail the same way, and hold up every later count
+            print("Dropped download counts that could not be flushed: %r" % (error), file=sys.stderr)
+            return
+        if self.on_flush is not None:
+            self.on_flush()
+
+    def _run(self):
+        """Flush until told to stop"""
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def stop(self):
+        """Stop the flusher thread, and flush whatever is left"""
+        if not self._start.started():
+            return
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.interval)
+        self.flush()
+
+
+class DownloadForwarder(DownloadCounter):
+    """Download counts of a read-only replica, sent to the primary's
+    /replica/downloads every `interval' seconds
+
+    `token' is the primary's replica_token.
+    """
+    def __init__(self, primary_url, token, interval=5.0, timeout=10.0):
+        super().__init__(None, interval=interval)
+        self.url = primary_url.rstrip("/") + "/replica/downloads"
+        self.token = token
+        self.timeout = timeout
+
+    def _write(self, pending):
+        """Send counts to the primary"""
+        body = json.dumps({str(game_id): count for game_id, count in pending.items()}).encode()
+        forward = urllib.request.Request(self.url, data=body, method="POST",
+                                         headers={"Content-Type": "application/json",
+                                                  "Authorization": "Bearer " + self.token})
+        with urllib.request.urlopen(forward, timeout=self.timeout) as response:
+            response.read()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  games.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""The game record, shared by the catalog, searches, listings and exports
+
+A Game is built straight from a row of the games table, by using from_row()
+as the cursor's row factory, and keeps its fields in slots instead of a
+dict. Its public fields are encoded as JSON the first time they are needed,
+and the bytes are kept, so a game in the catalog snapshot is encoded once
+however many listings and searches it shows up in.
+"""
+import copy
+import json
+from schema import GAME_COLUMNS
+
+
+# Columns to select for a Game, in the order Game() takes them
+COLUMNS = GAME_COLUMNS + ", id"
+# Encodes the same way catalog.encode_json() does
+ENCODER = json.JSONEncoder(sort_keys=True, separators=(",", ":"))
+# Names taken by fixed routes under /games/, which would hide a game's own
+RESERVED_NAMES = ("changes", "export", "new", "popular")
+
+
+def split_genres(value):
+    """Turn the genres column into a tuple of genres"""
+    if value is None:
+        return ()
+    return tuple(value.split(","))
+
+
+def upper(value):
+    return None if value is None else value.upper()
+
+
+def lower(value):
+    return None if value is None else value.lower()
+
+
+# Public fields, the column each comes from, and how to format the value
+FIELDS = {"Name": ("name", None),
+          "description": ("description", None),
+          "downloads": ("downloads", None),
+          "genres": ("genres", split_genres),
+          "joined": ("add_time", None),
+          "platform": ("platform", lower),
+          "rating": ("rating", upper),
+          "screenshots_url": ("screenshots_url", None)}
+# Game attributes named differently from the column they come from
+ATTRIBUTES = {"add_time": "joined"}
+
+
+class Game:
+    """One game
+
+    `downloads', `joined' and `id' are ints, `in_pack_man' is a bool, and
+    `genres' a tuple of strings. `rating' is upper case and `platform' lower
+    case. `id' is None when it wasn't selected, and `snippet' is only set by
+    free-text searches.
+    """
+    __slots__ = ("name", "submitter", "base64", "downloads", "genres", "url", "screenshots_url",
+                 "description", "rating", "platform", "joined", "in_pack_man", "id", "snippet",
+                 "_public_json")
+
+    def __init__(self, name, submitter, base64, downloads, genres, url, screenshots_url,
+                 description, rating, platform, joined, in_pack_man, id=None, snippet=None):
+        self.name = name
+        self.submitter = submitter
+        self.base64 = base64
+        self.downloads = downloads
+        self.genres = split_genres(genres)
+        self.url = url
+        self.screenshots_url = screenshots_url
+        self.description = description
+        self.rating = upper(rating)
+        self.platform = lower(platform)
+        self.joined = joined
+        self.in_pack_man = bool(in_pack_man)
+        self.id = id
+        self.snippet = snippet
+        self._public_json = None
+
+    def with_downloads(self, downloads):
+        """Get a copy of the game with a new download count"""
+        game = copy.copy(self)
+        game.downloads = downloads
+        game._public_json = None
+        return game
+
+    @classmethod
+    def from_row(cls, cursor, row):
+        """Row factory for queries selecting COLUMNS, optionally followed by
+        a snippet
+        """
+        return cls(*row)
+
+    def public(self):
+        """Get the fields the public endpoints show, which are the FIELDS"""
+        output = {field: getattr(self, ATTRIBUTES.get(column, column))
+                  for field, (column, format) in FIELDS.items()}
+        if self.snippet is not None:
+            output["snippet"] = self.snippet
+        return output
+
+    def public_json(self, snippet=None):
+        """Get public() as encoded JSON, with `snippet' in place of the
+        game's own if one is given
+
+        Keys are sorted and "snippet" sorts last, so it is added by splicing
+        it into the kept encoding of the other fields.
+        """
+        if self._public_json is None:
+            output = self.public()
+            output.pop("snippet", None)
+            self._public_json = ENCODER.encode(output).encode()
+        if snippet is None:
+            snippet = self.snippet
+        if snippet is None:
+            return self._public_json
+        return b'%s,"snippet":%s}' % (self._public_json[:-1], ENCODER.encode(snippet).encode())
+
+    def record(self):
+        """Get every field, in the format /import_games takes"""
+        return {"Name": self.name, "submitter": self.submitter, "base64": self.base64,
+                "downloads": self.downloads,
+                "genres": [each for each in self.genres if each != ""],
+                "URL": self.url, "screenshots_url": self.screenshots_url,
+                "description": self.description,
+                "rating": None if self.rating in (None, "NONE") else self.rating,
+                "platform": self.platform, "joined": self.joined,
+                "in_pack_man": self.in_pack_man}
+
+
+def select_games(db, query, params=()):
+    """Run a query selecting COLUMNS, and get a cursor over its rows as Games"""
+    cursor = db.execute(query, params)
+    cursor.row_factory = Game.from_row
+    return cursor
+
+
+def reserved_games(db):
+    """Get the names of games that fixed routes hide, by having the same name"""
+    return [row[0] for row in db.execute("SELECT name FROM games WHERE name IN (%s) ORDER BY name"
+                                         % (", ".join(["?"] * len(RESERVED_NAMES))), RESERVED_NAMES)]
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  links.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Background health checks of game download and screenshot links
+
+Links are only ever checked by `FLASK_APP=store flask check-links', which the
+store_links.timer systemd unit runs every hour, never while serving a
+request. Each link is fetched with HEAD, or GET for servers that refuse HEAD,
+following redirects, and the result goes into the link_checks table. A link
+is only checked again once its result is older than `ttl' seconds.
+
+Checks run concurrently on an asyncio event loop: at most `concurrency' at
+once, and at most `per_host' at once for any one host, with requests to the
+same host started at least `host_interval' seconds apart. A check taking
+longer than `timeout' seconds fails.
+"""
+import ssl
+import time
+import asyncio
+import urllib.parse
+
+
+# Default settings, overridable through "link_check" in settings.json
+DEFAULTS = {"concurrency": 16,
+            "per_host": 2,
+            "host_interval": 1.0,
+            "timeout": 10.0,
+            "ttl": 86400,
+            "batch_size": 100}
+MAX_REDIRECTS = 5
+REDIRECTS = (301, 302, 303, 307, 308)
+USER_AGENT = "Vetala-Store-Link-Checker/1.0"
+
+
+class LinkError(Exception):
+    """A link could not be fetched"""
+
+
+async def _request(method, url):
+    """Send one request, returning the status and the Location header"""
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise LinkError("Not an http or https URL")
+    host = parts.hostname.encode("idna").decode()
+    port = parts.port
+    if port is None:
+        port = 443 if parts.scheme == "https" else 80
+    else:
+        host = "%s:%d" % (host, port)
+    path = urllib.parse.quote(parts.path or "/", safe="/%:@!$&'()*+,;=~-._")
+    if parts.query != "":
+        path += "?" + urllib.parse.quote(parts.query, safe="/%:@!$&'()*+,;=?~-._")
+    reader, writer = await asyncio.open_connection(
+        parts.hostname.encode("idna").decode(), port,
+        ssl=ssl.create_default_context() if parts.scheme == "https" else None)
+    try:
+        writer.write(("%s %s HTTP/1.1\r\nHost: %s\r\nUser-Agent: %s\r\nAccept: */*\r\n"
+                      "Connection: close\r\n\r\n" % (method, path, host, USER_AGENT)).encode())
+        await writer.drain()
+        status = (await reader.readline()).decode("latin-1").split(" ")
+        if len(status) < 2 or not status[0].startswith("HTTP/") or not status[1].isdigit():
+            raise LinkError("Not an HTTP response")
+        location = None
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if line == "":
+                break
+            if line.lower().startswith("location:"):
+                location = line.split(":", 1)[1].strip()
+        return int(status[1]), location
+    finally:
+        writer.close()
+
+
+async def fetch_status(url):
+    """Get the HTTP status of `url', after following redirects
+
+    This is the default fetcher. Any coroutine function taking a URL and
+    returning a status, or raising, will do in its place.
+    """
+    for each in range(MAX_REDIRECTS + 1):
+        status, location = await _request("HEAD", url)
+        if status in (405, 501):
+            status, location = await _request("GET", url)
+        if status not in REDIRECTS or location is None:
+            return status
+        url = urllib.parse.urljoin(url, location)
+    raise LinkError("Too many redirects")
+
+
+class _Host:
+    """Rate limit for one host"""
+    def __init__(self, per_host):
+        self.slots = asyncio.Semaphore(per_host)
+        self.next_start = 0.0
+
+
+class LinkChecker:
+    """Checks every link that is due, and caches the results
+
+    `fetch' is the fetcher to use instead of fetch_status(), and `options'
+    override DEFAULTS.
+    """
+    def __init__(self, database, fetch=None, **options):
+        options = dict(DEFAULTS, **options)
+        self.database = database
+        self.fetch = fetch_status if fetch is None else fetch
+        self.concurrency = options["concurrency"]
+        self.per_host = options["per_host"]
+        self.host_interval = options["host_interval"]
+        self.timeout = options["timeout"]
+        self.ttl = options["ttl"]
+        self.batch_size = options["batch_size"]
+
+    def due(self):
+        """Get the links without a result newer than the TTL
+
+        Package names, which games in a package manager have instead of a
+        download URL, are not links, and neither are empty screenshot URLs.
+        """
+        return [each[0] for each in self.database.get().execute("""SELECT link FROM
+        (SELECT url AS link FROM games WHERE NOT in_pack_man
+        UNION SELECT screenshots_url FROM games)
+        WHERE link IS NOT NULL AND link != ''
+        AND link NOT IN (SELECT url FROM link_checks WHERE checked > ?)
+        ORDER BY link""", (int(time.time()) - self.ttl,))]
+
+    async def _check(self, url, slots, hosts):
+        """Check one link, returning its link_checks row"""
+        host = hosts.setdefault(urllib.parse.urlsplit(url).hostname, _Host(self.per_host))
+        async with host.slots:
+            # Book the host's next start time before waiting for it
+            now = asyncio.get_running_loop().time()
+            start = max(now, host.next_start)
+            host.next_start = start + self.host_interval
+            await asyncio.sleep(start - now)
+            async with slots:
+                try:
+                    status = await asyncio.wait_for(self.fetch(url), self.timeout)
+                    return (url, status, None, int(time.time()))
+                except asyncio.TimeoutError:
+                    error = "Timed out after %s seconds" % (self.timeout)
+                except (OSError, ValueError, LinkError) as failure:
+                    error = str(failure) or failure.__class__.__name__
+                return (url, None, error, int(time.time()))
+
+    def _save(self, rows):
+        """Cache a batch of results"""
+        with self.database.transaction() as db:
+            db.executemany("""INSERT OR REPLACE INTO link_checks (url, status, error, checked)
+            VALUES (?, ?, ?, ?)""", rows)
+
+    async def _check_all(self, links):
+        slots = asyncio.Semaphore(self.concurrency)
+        hosts = {}
+        checked = broken = 0
+        batch = []
+        for result in asyncio.as_completed([self._check(each, slots, hosts) for each in links]):
+            row = await result
+            batch.append(row)
+            checked += 1
+            if is_broken(row[1], row[2]):
+                broken += 1
+            if len(batch) >= self.batch_size:
+                self._save(batch)
+                batch = []
+        if batch != []:
+            self._save(batch)
+        return checked, broken
+
+    def run(self):
+        """Check every link that is due
+
+        Results of links no game has any more are dropped first. Returns how
+        many links were checked, and how many of them are broken.
+        """
+        with self.database.transaction() as db:
+            db.execute("""DELETE FROM link_checks WHERE url NOT IN
+            (SELECT url FROM games WHERE url IS NOT NULL
+            UNION SELECT screenshots_url FROM games WHERE screenshots_url IS NOT NULL)""")
+        links = self.due()
+        if links == []:
+            return 0, 0
+        return asyncio.run(self._check_all(links))
+
+
+def is_broken(status, error):
+    """Whether a link_checks result is a broken link"""
+    return error is not None or status >= 400
+
+
+def broken_links(db, submitter=None):
+    """Get every broken link, as (name, field, URL, status, error, checked)
+    rows, sorted by game name
+
+    If `submitter' is given, only their games are included.
+    """
+    scope, params = "", []
+    if submitter is not None:
+        scope, params = " AND games.submitter = ?", [submitter]
+    broken = "(link_checks.error IS NOT NULL OR link_checks.status >= 400)"
+    return db.execute("""SELECT games.name, 'URL', games.url, status, error, checked
+    FROM games JOIN link_checks ON link_checks.url = games.url
+    WHERE NOT games.in_pack_man AND %s%s
+    UNION ALL
+    SELECT games.name, 'screenshots_url', games.screenshots_url, status, error, checked
+    FROM games JOIN link_checks ON link_checks.url = games.screenshots_url
+    WHERE %s%s
+    ORDER BY 1, 2""" % (broken, scope, broken, scope), params + params).fetchall()
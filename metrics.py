@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  metrics.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Request, query and cache metrics, shared across uWSGI workers
+
+Each worker keeps its counters and histograms in memory, so recording one
+costs a lock and a couple of dict updates, and a background thread writes
+them to the worker's own file in a spool directory every few seconds.
+/metrics merges the files of every worker, and renders them in the
+Prometheus text format. The files of workers that have exited are folded into
+a single retired file, so counters never go backwards, and the spool doesn't
+grow with every worker restart.
+"""
+import os
+import json
+import time
+import fcntl
+import atexit
+import bisect
+import tempfile
+import threading
+from flask import request
+from workers import PerProcess
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5)
+# Upper bounds of the response size histogram buckets, in bytes
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+# Type and help text of every metric
+DESCRIPTIONS = {
+    "vetala_requests_total": ("counter", "Requests served, by route, method and status"),
+    "vetala_request_exceptions_total": ("counter", "Requests that raised an unhandled exception"),
+    "vetala_request_duration_seconds": ("histogram", "Time to build a response, by route"),
+    "vetala_response_size_bytes": ("histogram", "Response body size, by route, when known up front"),
+    "vetala_sqlite_queries_total": ("counter", "SQLite statements run, by the route running them"),
+    "vetala_sqlite_query_seconds_total": ("counter", "Time spent in SQLite statements, by route"),
+    "vetala_cache_requests_total": ("counter", "Cache lookups, by cache and result"),
+    "vetala_worker_requests_total": ("counter", "Requests served, by uWSGI worker"),
+    "vetala_worker_info": ("gauge", "Running workers, by uWSGI worker ID and PID"),
+    "vetala_admin_searches_total": ("counter", "Remove page searches, by whether they cover all games or the user's own"),
+}
+# Spool file holding the merged metrics of every worker that has exited
+RETIRED = "retired.json"
+
+
+def _labels(labels):
+    """Render a tuple of (name, value) label pairs"""
+    if labels == ():
+        return ""
+    return "{%s}" % (",".join(['%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                               for name, value in labels]))
+
+
+def _number(value):
+    """Render a sample value"""
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def worker_id():
+    """Get this process's uWSGI worker ID, or 0 outside uWSGI"""
+    if uwsgi is None:
+        return 0
+    return uwsgi.worker_id()
+
+
+class Metrics:
+    """Per-worker metrics, spooled to `spool' every `interval' seconds"""
+    def __init__(self, spool, interval=5.0):
+        self.spool = spool
+        self.interval = interval
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._thread = None
+        self._path = None
+        self._start = PerProcess(self._start_thread, self._lock)
+        atexit.register(self.stop)
+
+    def _start_thread(self):
+        """Start this worker's spooling thread, once it serves a request
+
+        Every worker starts over from zero, in a file of its own, forgetting
+        whatever was counted before the fork.
+        """
+        self._counters = {}
+        self._histograms = {}
+        self._worker_key = ("vetala_worker_requests_total", (("worker", worker_id()),))
+        os.makedirs(self.spool, exist_ok=True)
+        # The start time keeps a reused PID from overwriting a dead worker's file
+        self._path = os.path.join(self.spool, "%d-%d.json" % (os.getpid(), time.time_ns()))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-spooler", daemon=True)
+        self._thread.start()
+
+    def incr(self, name, labels=(), amount=1):
+        """Add to a counter"""
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels=(), buckets=LATENCY_BUCKETS):
+        """Add a value to a histogram"""
+        with self._lock:
+            self._observe(name, value, labels, buckets)
+
+    def _observe(self, name, value, labels, buckets):
+        """observe(), for callers already holding the lock"""
+        key = (name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = [list(buckets), [0] * (len(buckets) + 1), 0, 0]
+        histogram[1][bisect.bisect_left(buckets, value)] += 1
+        histogram[2] += value
+        histogram[3] += 1
+
+    def add_collector(self, func):
+        """Add a function returning extra counters, as (name, labels, value)
+        tuples, to read every time the metrics are spooled
+        """
+        self._collectors.append(func)
+
+    def on_query(self, seconds):
+        """Count a SQLite statement, against the route this thread is serving"""
+        labels = (("route", getattr(self._local, "route", "none")),)
+        with self._lock:
+            key = ("vetala_sqlite_queries_total", labels)
+            self._counters[key] = self._counters.get(key, 0) + 1
+            key = ("vetala_sqlite_query_seconds_total", labels)
+            self._counters[key] = self._counters.get(key, 0) + seconds
+
+    def install(self, app):
+        """Time every request `app' serves"""
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    def _before_request(self):
+        self._start()
+        local = self._local
+        current = request._get_current_object()
+        local.route = current.url_rule.rule if current.url_rule is not None else "unmatched"
+        local.method = current.method
+        local.start = time.perf_counter()
+
+    def _after_request(self, response):
+        """Record a request, taking the lock only once"""
+        local = self._local
+        elapsed = time.perf_counter() - local.start
+        route = (("route", local.route),)
+        size = None if response.is_streamed else response.headers.get("Content-Length")
+        counters = self._counters
+        with self._lock:
+            self._observe("vetala_request_duration_seconds", elapsed, route, LATENCY_BUCKETS)
+            if size is not None:
+                self._observe("vetala_response_size_bytes", int(size), route, SIZE_BUCKETS)
+            key = ("vetala_requests_total", route + (("method", local.method),
+                                                     ("status", response.status_code)))
+            counters[key] = counters.get(key, 0) + 1
+            counters[self._worker_key] = counters.get(self._worker_key, 0) + 1
+        return response
+
+    def _teardown_request(self, exception):
+        if exception is not None:
+            self.incr("vetala_request_exceptions_total", (("route", self._local.route),))
+        self._local.route = "none"
+
+    def snapshot(self):
+        """Get this worker's metrics, in the spool file format"""
+        counters = []
+        for func in self._collectors:
+            counters.extend(func())
+        with self._lock:
+            counters.extend([(name, labels, value) for (name, labels), value in self._counters.items()])
+            histograms = [(name, labels, histogram[0], list(histogram[1]), histogram[2], histogram[3])
+                          for (name, labels), histogram in self._histograms.items()]
+        return {"pid": os.getpid(), "worker": worker_id(),
+                "counters": [[name, [list(each) for each in labels], value]
+                             for name, labels, value in counters],
+                "histograms": [[name, [list(each) for each in labels], buckets, counts, total, count]
+                               for name, labels, buckets, counts, total, count in histograms]}
+
+    def flush(self):
+        """Write this worker's metrics to its spool file"""
+        if not self._start.started():
+            return
+        handle, temp = tempfile.mkstemp(dir=self.spool, prefix=".metrics-")
+        try:
+            with os.fdopen(handle, "w") as file:
+                json.dump(self.snapshot(), file)
+            os.replace(temp, self._path)
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+    def _run(self):
+        """Spool until told to stop"""
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def stop(self):
+        """Stop the spooling thread, and spool whatever is left"""
+        if not self._start.started():
+            return
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.interval)
+        try:
+            self.flush()
+        except OSError:
+            pass
+
+    def collect(self):
+        """Merge every worker's spool file, and render them for Prometheus
+
+        Files of workers that have exited are folded into the retired file
+        first, and deleted, so the spool only ever holds one file per
+        running worker, plus that one.
+        """
+        self._start()
+        self.flush()
+        counters = {}
+        histograms = {}
+        workers = []
+        with open(os.path.join(self.spool, ".lock"), "w") as lock:
+            # One worker at a time, or two could fold the same file
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            retired, running = self._retire()
+        _merge(counters, histograms, retired)
+        for data in running:
+            workers.append((data["worker"], data["pid"]))
+            _merge(counters, histograms, data)
+        return _render(counters, histograms, workers)
+
+    def _retire(self):
+        """Fold the files of exited workers into the retired file
+
+        The retired file lists the files folded into it last, so if this is
+        cut short before they are deleted, they are not counted twice.
+        Returns the retired file's data, and that of every running worker.
+        """
+        path = os.path.join(self.spool, RETIRED)
+        retired = _read(path) or {"counters": [], "histograms": [], "files": []}
+        folded = set(retired["files"])
+        running = []
+        exited = []
+        for each in sorted(os.listdir(self.spool)):
+            if each.startswith(".") or each == RETIRED:
+                continue
+            if each in folded:
+                _remove(os.path.join(self.spool, each))
+                continue
+            data = _read(os.path.join(self.spool, each))
+            if data is None:
+                continue
+            if _alive(data["pid"]):
+                running.append(data)
+            else:
+                exited.append((each, data))
+        if exited == []:
+            return retired, running
+        counters = {}
+        histograms = {}
+        for data in [retired] + [data for each, data in exited]:
+            _merge(counters, histograms, data)
+        retired = {"counters": [[name, [list(pair) for pair in labels], value]
+                                for (name, labels), value in counters.items()],
+                   "histograms": [[name, [list(pair) for pair in labels]] + histogram
+                                  for (name, labels), histogram in histograms.items()],
+                   "files": [each for each, data in exited]}
+        handle, temp = tempfile.mkstemp(dir=self.spool, prefix=".metrics-")
+        try:
+            with os.fdopen(handle, "w") as file:
+                json.dump(retired, file)
+            os.replace(temp, path)
+        except BaseException:
+            _remove(temp)
+            raise
+        for each, data in exited:
+            _remove(os.path.join(self.spool, each))
+        return retired, running
+
+
+def _read(path):
+    """Read a spool file, or get None if it can't be read"""
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _remove(path):
+    """Delete a file, if it is still there"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _merge(counters, histograms, data):
+    """Add the counters and histograms of a spool file to merged ones"""
+    for name, labels, value in data["counters"]:
+        key = (name, tuple(tuple(pair) for pair in labels))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, buckets, counts, total, count in data["histograms"]:
+        key = (name, tuple(tuple(pair) for pair in labels))
+        merged = histograms.get(key)
+        if merged is None or merged[0] != buckets:
+            histograms[key] = merged = [buckets, [0] * len(counts), 0, 0]
+        merged[1] = [a + b for a, b in zip(merged[1], counts)]
+        merged[2] += total
+        merged[3] += count
+
+
+def _alive(pid):
+    """Check if a process is still running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _render(counters, histograms, workers):
+    """Render merged metrics in the Prometheus text format"""
+    samples = {}
+    for (name, labels), value in counters.items():
+        samples.setdefault(name, []).append("%s%s %s" % (name, _labels(labels), _number(value)))
+    for (name, labels), (buckets, counts, total, count) in histograms.items():
+        lines = samples.setdefault(name, [])
+        cumulative = 0
+        for bound, each in zip(list(buckets) + ["+Inf"], counts):
+            cumulative += each
+            lines.append("%s_bucket%s %d" % (name, _labels(labels + (("le", bound),)), cumulative))
+        lines.append("%s_sum%s %s" % (name, _labels(labels), _number(total)))
+        lines.append("%s_count%s %d" % (name, _labels(labels), count))
+    samples["vetala_worker_info"] = ["vetala_worker_info%s 1" % (_labels((("worker", worker), ("pid", pid))))
+                                     for worker, pid in sorted(workers)]
+    output = []
+    for name in sorted(samples):
+        kind, text = DESCRIPTIONS.get(name, ("untyped", name))
+        output.append("# HELP %s %s" % (name, text))
+        output.append("# TYPE %s %s" % (name, kind))
+        output.extend(samples[name])
+    return "\n".join(output) + "\n"
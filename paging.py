@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  paging.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Keyset pagination and field projection for listings and searches
+
+Pages are read straight from SQLite, one page at a time, and only the
+requested columns are selected. A cursor holds the sort key of the last game
+on the previous page, so pages stay stable even as games are added.
+"""
+import json
+import base64
+from catalog import encode_json
+from games import FIELDS
+from search_index import fulltext_query, tag_filter, NAME_WEIGHT, DESCRIPTION_WEIGHT, SNIPPET_TOKENS
+
+
+# Only free-text searches have snippets
+SNIPPET = "snippet"
+
+
+def parse_fields(text, snippet=False):
+    """Get the list of fields asked for in a fields= parameter
+
+    Raises ValueError for unknown fields.
+    """
+    if text is None or text == "":
+        fields = list(FIELDS)
+        if snippet:
+            fields.append(SNIPPET)
+        return fields
+    fields = list(dict.fromkeys(each.strip() for each in text.split(",")))
+    for each in fields:
+        if each not in FIELDS and not (snippet and each == SNIPPET):
+            raise ValueError("Unknown field: %s" % (each))
+    return fields
+
+
+def encode_cursor(key):
+    """Turn a sort key into an opaque cursor"""
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor, size=1):
+    """Turn a cursor back into a sort key of `size' values, or None for the
+    first page
+
+    Raises ValueError if the cursor is not one we made.
+    """
+    if cursor is None or cursor == "":
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if ((not isinstance(key, list)) or (len(key) != size) or
+            (not all(isinstance(each, (int, float)) for each in key))):
+        raise ValueError("Invalid cursor")
+    return key
+
+
+def _columns(fields):
+    """Get the SQL column list for `fields'"""
+    return ", ".join([FIELDS[each][0] for each in fields if each != SNIPPET])
+
+
+def _format(row, fields):
+    """Turn a row into a dict of the given fields"""
+    game = {}
+    for position, field in enumerate(fields):
+        value = row[position]
+        if field != SNIPPET and FIELDS[field][1] is not None:
+            value = FIELDS[field][1](value)
+        game[field] = value
+    return game
+
+
+def _page(rows, fields, limit, key_size):
+    """Format one page of rows, and make the cursor for the next one
+
+    Every row ends with its sort key, and there is one row more than the
+    page holds if there is a next page.
+    """
+    output = {}
+    for index, row in enumerate(rows[:limit]):
+        output[index] = _format(row, fields)
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_cursor(list(rows[limit - 1][-key_size:]))
+    return output, next_cursor
+
+
+def list_games(db, fields, limit, cursor=None):
+    """Get one page of the catalog, in table order"""
+    key = decode_cursor(cursor)
+    last = -1 if key is None else key[0]
+    rows = db.execute("SELECT %s, id FROM games WHERE id > ? ORDER BY id LIMIT ?" % (_columns(fields)),
+                      (last, limit + 1)).fetchall()
+    return _page(rows, fields, limit, 1)
+
+
+def tag_page(db, tags, fields, limit, cursor=None, match_all=False):
+    """Get one page of a tag search, in table order"""
+    key = decode_cursor(cursor)
+    last = -1 if key is None else key[0]
+    games, params = tag_filter(tags, match_all)
+    rows = db.execute("""SELECT %s, id FROM games WHERE id IN (%s) AND id > ?
+    ORDER BY id LIMIT ?""" % (_columns(fields), games), params + [last, limit + 1]).fetchall()
+    return _page(rows, fields, limit, 1)
+
+
+def text_page(db, text, fields, limit, cursor=None):
+    """Get one page of a free-text search, best matches first"""
+    key = decode_cursor(cursor, size=2)
+    query = fulltext_query(text)
+    if query is None:
+        return {}, None
+    columns = [FIELDS[each][0] if each != SNIPPET else SNIPPET for each in fields]
+    snippet = ""
+    if SNIPPET in fields:
+        snippet = ", snippet(games_fts, 1, '<b>', '</b>', '...', %d) AS snippet" % (SNIPPET_TOKENS)
+    if key is None:
+        after = ""
+        params = (query, limit + 1)
+    else:
+        after = "WHERE (rank, id) > (?, ?)"
+        params = (query, key[0], key[1], limit + 1)
+    rows = db.execute("""SELECT %s, rank, id FROM
+    (SELECT rowid AS match_id, bm25(games_fts, %s, %s) AS rank%s
+    FROM games_fts WHERE games_fts MATCH ?)
+    JOIN games ON games.id = match_id %s
+    ORDER BY rank, id LIMIT ?""" % (", ".join(columns), NAME_WEIGHT, DESCRIPTION_WEIGHT,
+                                    snippet, after), params).fetchall()
+    return _page(rows, fields, limit, 2)
+
+
+def export_games(db, fields, chunk_size=500):
+    """Stream the whole catalog as newline delimited JSON
+
+    Yields chunks of `chunk_size' games, read with fetchmany() inside one
+    read transaction, so memory use does not grow with the catalog. `db' is
+    closed once the export is done or abandoned.
+    """
+    try:
+        db.execute("BEGIN DEFERRED")
+        cursor = db.execute("SELECT %s FROM games ORDER BY id" % (_columns(fields)))
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if rows == []:
+                break
+            yield b"".join([encode_json(_format(each, fields)) + b"\n" for each in rows])
+    finally:
+        db.close()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  passwords.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Password hashing for admin accounts
+
+Passwords are hashed with scrypt or PBKDF2, and the parameters used are kept
+in the account's record next to the hash and its salt, so the cost can be
+raised later without locking anyone out. Records from older versions, which
+hash the password `rehash_count' times with `hash_algo', are still accepted,
+and flagged so they get replaced on the next successful login.
+
+A hash ties up the worker running it, so at most `max_concurrent' hashes run
+at once across every uWSGI worker. Each one holds a lock on one byte of a
+small file, ideally on a tmpfs like /dev/shm, that every worker shares. A
+login finding every byte locked is turned away with Busy straight away, so a
+burst of logins never takes more than that many workers off the catalog.
+"""
+import os
+import hmac
+import fcntl
+import threading
+import hashlib as hash
+
+
+KDFS = ("scrypt", "pbkdf2")
+# Default cost settings, overridable through "password_hashing" in settings.json
+DEFAULTS = {"kdf": "scrypt",
+            "scrypt": {"n": 16384, "r": 8, "p": 1},
+            "pbkdf2": {"hash_name": "sha256", "iterations": 600000},
+            "salt_bytes": 16,
+            "max_concurrent": 2,
+            "slots_file": "/dev/shm/vetala-store-password-slots"}
+# Fields only found in records from older versions
+LEGACY_FIELDS = ("hash_algo", "rehash_count")
+
+
+class Busy(Exception):
+    """Too many passwords are already being hashed"""
+
+
+def derive(password, kdf, params, salt):
+    """Hash `password' with one of the KDFS, returning the hex digest"""
+    if kdf == "scrypt":
+        # scrypt needs 128 * r * (n + p) bytes; leave some room on top
+        return hash.scrypt(password.encode(), salt=salt, n=params["n"], r=params["r"],
+                           p=params["p"], dklen=32,
+                           maxmem=128 * params["r"] * (params["n"] + params["p"]) + 1048576).hex()
+    if kdf == "pbkdf2":
+        return hash.pbkdf2_hmac(params["hash_name"], password.encode(), salt,
+                                params["iterations"]).hex()
+    raise ValueError("Unknown KDF: %s" % (kdf))
+
+
+def legacy_hash(password, hash_algo, rehash_count):
+    """Hash `password' the way older versions did"""
+    hash_func = getattr(hash, hash_algo.lower())
+    for each in range(rehash_count):
+        password = hash_func(password.encode()).hexdigest()
+    return password
+
+
+class PasswordHasher:
+    """Makes and checks password hashes, at most `max_concurrent' at once
+    across every process sharing `slots_file'
+    """
+    def __init__(self, **options):
+        options = dict(DEFAULTS, **options)
+        if options["kdf"] not in KDFS:
+            raise ValueError("Unknown KDF: %s" % (options["kdf"]))
+        self.kdf = options["kdf"]
+        self.params = {each: dict(DEFAULTS[each], **options[each]) for each in KDFS}
+        self.salt_bytes = options["salt_bytes"]
+        self.max_concurrent = options["max_concurrent"]
+        self._fd = os.open(options["slots_file"], os.O_RDWR | os.O_CREAT, 0o600)
+        # Byte-range locks don't keep out other threads of the same process
+        self._lock = threading.Lock()
+        self._held = set()
+
+    def _acquire(self):
+        """Lock a free slot, and get its number
+
+        Raises Busy if every slot is taken, instead of waiting for one.
+        """
+        with self._lock:
+            for slot in range(self.max_concurrent):
+                if slot in self._held:
+                    continue
+                try:
+                    fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, slot)
+                except (BlockingIOError, PermissionError):
+                    continue
+                self._held.add(slot)
+                return slot
+        raise Busy()
+
+    def _run(self, func, *args):
+        """Run `func' while holding a slot"""
+        slot = self._acquire()
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, slot)
+                self._held.discard(slot)
+
+    def make(self, password, kdf=None):
+        """Hash a new password, with `kdf' or the configured one
+
+        Returns the fields to store in the account's record. Legacy fields
+        are set to None, so they get dropped from records being replaced.
+        """
+        if kdf is None:
+            kdf = self.kdf
+        if kdf not in KDFS:
+            raise ValueError("Unknown KDF: %s" % (kdf))
+        salt = os.urandom(self.salt_bytes)
+        output = {"password_hash": self._run(derive, password, kdf, self.params[kdf], salt),
+                  "kdf": kdf, "kdf_params": dict(self.params[kdf]), "salt": salt.hex()}
+        for each in LEGACY_FIELDS:
+            output[each] = None
+        return output
+
+    def verify(self, record, password):
+        """Check `password' against an account's record
+
+        Returns a tuple of whether it matched, and whether the record should
+        be replaced with a fresh hash because it uses a legacy scheme, or its
+        KDF's cost settings have changed since it was made.
+        """
+        if record.get("kdf") is None:
+            generated = self._run(legacy_hash, password, record["hash_algo"],
+                                  record["rehash_count"])
+            outdated = True
+        else:
+            generated = self._run(derive, password, record["kdf"], record["kdf_params"],
+                                  bytes.fromhex(record["salt"]))
+            outdated = record["kdf_params"] != self.params[record["kdf"]]
+        valid = hmac.compare_digest(generated, record["password_hash"])
+        return valid, valid and outdated
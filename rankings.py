@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  rankings.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Games ranked by popularity and by how new they are"""
+import bisect
+import heapq
+import time
+
+
+# How fast old downloads stop counting towards decayed popularity
+DECAY_GRAVITY = 1.5
+
+
+class Ranking:
+    """Game IDs kept sorted by a key, best first
+
+    Keys sort ascending, so use negated scores to put the highest first.
+    Changing one game's key moves only that game.
+    """
+    def __init__(self):
+        self._order = []
+        self._keys = {}
+
+    def __len__(self):
+        return len(self._order)
+
+    def update(self, game_id, key):
+        """Add a game, or move it to its new key"""
+        old = self._keys.get(game_id)
+        if old == key:
+            return
+        if old is not None:
+            del self._order[bisect.bisect_left(self._order, (old, game_id))]
+        bisect.insort(self._order, (key, game_id))
+        self._keys[game_id] = key
+
+    def remove(self, game_id):
+        """Remove a game"""
+        old = self._keys.pop(game_id, None)
+        if old is not None:
+            del self._order[bisect.bisect_left(self._order, (old, game_id))]
+
+    def sync(self, keys):
+        """Bring the ranking in line with `keys', a dict of game ID to key
+
+        Only games that were added, removed or changed are touched.
+        """
+        for game_id in [each for each in self._keys if each not in keys]:
+            self.remove(game_id)
+        for game_id, key in keys.items():
+            self.update(game_id, key)
+
+    def ids(self, count=None):
+        """Get the IDs of the top `count' games, or of all of them"""
+        if count is None:
+            return [each[1] for each in self._order]
+        return [each[1] for each in self._order[:count]]
+
+
+def popularity_key(downloads, add_time):
+    """Most downloads first, then newest"""
+    return (-downloads, -add_time)
+
+
+def recency_key(downloads, add_time):
+    """Newest first, then most downloads"""
+    return (-add_time, -downloads)
+
+
+def decayed_score(downloads, add_time, now):
+    """Downloads, discounted by how long the game has been around"""
+    age_hours = max(now - add_time, 0) / 3600
+    return downloads / ((age_hours + 2) ** DECAY_GRAVITY)
+
+
+def top_decayed(games, count, now=None):
+    """Get the IDs of the `count' games with the best decayed score
+
+    `games' is an iterable of (game ID, downloads, add time).
+    """
+    if now is None:
+        now = time.time()
+    best = heapq.nlargest(count, games, key=lambda each: decayed_score(each[1], each[2], now))
+    return [each[0] for each in best]
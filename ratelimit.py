@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  ratelimit.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Per-client, per-route request rate limits, shared across uWSGI workers
+
+Every client gets a token bucket for each route with a rule of its own, and
+one more for every other route. A request takes a token, and a bucket
+refills at `rate' tokens a second, up to `burst'. Requests finding their
+bucket empty get a 429 with a Retry-After header.
+
+Buckets live in a memory-mapped file, ideally on a tmpfs like /dev/shm, that
+every worker maps, so a client gets the same budget whichever worker serves
+it. The file is a hash table of groups of WAYS buckets. A client whose group
+is full takes over the bucket that has been idle longest. Each group is
+guarded by a lock on its byte range, so workers only wait on each other when
+they touch the same group.
+"""
+import os
+import math
+import mmap
+import time
+import fcntl
+import hashlib
+import threading
+from flask import request
+
+
+# Buckets per group
+WAYS = 4
+# A bucket's key, tokens left and when it was last updated
+BUCKET_SIZE = 24
+# Route name of requests for URLs no route matches
+UNMATCHED = "unmatched"
+
+
+def _bucket(rule):
+    """Get (rate, burst) from a rule in the settings file"""
+    rate, burst = float(rule["rate"]), float(rule["burst"])
+    if rate <= 0 or burst < 1:
+        raise ValueError("Rate limits need a rate above 0 and a burst of at least 1")
+    return rate, burst
+
+
+class RateLimiter:
+    """Token buckets in the file at `path', with room for `slots' clients
+
+    `default' is the rule for routes without one in `routes', which maps URL
+    rules, like "/search/<term>", to rules. Rules are objects with a "rate"
+    and a "burst". Routes in `exempt' are never limited.
+    """
+    def __init__(self, path, default, routes=None, exempt=(), slots=65536):
+        self.default = _bucket(default)
+        self.routes = {route: _bucket(rule) for route, rule in (routes or {}).items()}
+        self.exempt = frozenset(exempt)
+        self.groups = max(slots // WAYS, 1)
+        self._group_size = BUCKET_SIZE * WAYS
+        size = self.groups * self._group_size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        # Never shrunk, since a process still mapping it would crash
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._buckets = memoryview(self._map).cast("d")
+        # Byte-range locks don't keep out other threads of the same process
+        self._lock = threading.Lock()
+
+    def take(self, route, client):
+        """Take a token from `client''s bucket for `route'
+
+        Returns 0 if there was one, or else how many seconds until there is.
+        """
+        if route in self.exempt:
+            return 0.0
+        rate, burst = self.routes.get(route, self.default)
+        if route not in self.routes:
+            route = ""
+        digest = hashlib.blake2b(("%s\0%s" % (route, client)).encode(), digest_size=6).digest()
+        # 48 bits, so the key survives being stored as a double, and never 0, which is an empty bucket
+        key = float(int.from_bytes(digest, "little") | 1)
+        group = int(key) % self.groups
+        first = group * WAYS * 3
+        buckets = self._buckets
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self._group_size, group * self._group_size)
+            try:
+                now = time.monotonic()
+                index = None
+                idlest = first
+                for each in range(first, first + WAYS * 3, 3):
+                    if buckets[each] == key:
+                        index = each
+                        break
+                    if buckets[each + 2] < buckets[idlest + 2]:
+                        idlest = each
+                if index is None:
+                    index = idlest
+                    tokens = burst
+                else:
+                    # A clock that went backwards refills nothing, but doesn't stop refills after
+                    tokens = min(burst, buckets[index + 1] + max(now - buckets[index + 2], 0.0) * rate)
+                if tokens >= 1:
+                    tokens -= 1
+                    wait = 0.0
+                else:
+                    wait = (1 - tokens) / rate
+                buckets[index] = key
+                buckets[index + 1] = tokens
+                buckets[index + 2] = now
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self._group_size, group * self._group_size)
+        return wait
+
+    def install(self, app):
+        """Limit every request `app' serves"""
+        app.before_request(self._before_request)
+
+    def _before_request(self):
+        rule = request.url_rule
+        wait = self.take(rule.rule if rule is not None else UNMATCHED, request.remote_addr or "")
+        if wait > 0:
+            return ({"Error": "Too many requests. Please slow down, and retry later."}, 429,
+                    {"Retry-After": str(math.ceil(wait))})
+        return None
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  replication.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Catalog snapshots, for read-only replicas on other nodes
+
+The primary publishes the catalog as a compacted, read-only copy of its DB,
+made with VACUUM INTO, to a directory, along with a manifest naming the
+newest copy, its catalog generation and its SHA-256. Copies are named after
+their checksum, and the manifest is replaced last, so the directory can be
+synced to other nodes with rsync or anything like it.
+
+Replicas serve the read endpoints from the newest copy in their own
+directory. Each worker checks the manifest in the background, and moves to a
+new copy once its checksum matches. Requests already running on the old copy
+finish on it, since an open file outlives being deleted.
+"""
+import os
+import sys
+import json
+import time
+import fcntl
+import hashlib
+import tempfile
+import threading
+import urllib.parse
+import sqlite3 as sql
+from database import Database, TimedConnection
+from catalog import get_versions
+from changes import latest_change
+from schema import SCHEMA_VERSION, get_version
+from workers import PerProcess
+
+
+MANIFEST = "manifest.json"
+LOCK = ".lock"
+
+
+def read_manifest(directory):
+    """Get the manifest of a snapshot directory, or None if there isn't one"""
+    try:
+        with open(os.path.join(directory, MANIFEST), "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def file_checksum(path):
+    """Get the SHA-256 of a file, in hex"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1048576), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_manifest(directory, manifest):
+    """Replace the manifest, so readers see either the old one or the new one"""
+    handle, temp = tempfile.mkstemp(dir=directory, prefix=".manifest-")
+    try:
+        with os.fdopen(handle, "w") as file:
+            json.dump(manifest, file, sort_keys=True, indent=4)
+        os.replace(temp, os.path.join(directory, MANIFEST))
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def _prune(directory, keep):
+    """Delete all but the newest `keep' snapshots"""
+    snapshots = []
+    for each in os.listdir(directory):
+        if each.startswith("catalog-") and each.endswith(".sql"):
+            path = os.path.join(directory, each)
+            snapshots.append((os.stat(path).st_mtime_ns, path))
+    for mtime, path in sorted(snapshots, reverse=True)[max(keep, 1):]:
+        os.remove(path)
+
+
+def publish(database, directory, keep=3):
+    """Publish a snapshot of the catalog to `directory', unless the newest
+    one is already up to date
+
+    Returns the new manifest, or None if nothing was published. Only one
+    process publishes at a time.
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, LOCK), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        current = read_manifest(directory)
+        db = database.get()
+        if (current is not None and (current["version"], current.get("downloads")) == get_versions(db) and
+                os.path.isfile(os.path.join(directory, current["file"]))):
+            return None
+        temp = os.path.join(directory, ".catalog-%d.tmp" % (os.getpid()))
+        if os.path.exists(temp):
+            os.remove(temp)
+        try:
+            # VACUUM INTO can't run inside a transaction, but its copy is consistent,
+            # so everything about the snapshot is read back from the copy itself
+            db.execute("VACUUM INTO ?", (temp,))
+            snapshot = sql.connect("file:%s?immutable=1" % (urllib.parse.quote(os.path.abspath(temp))),
+                                   uri=True)
+            try:
+                generation, downloads = get_versions(snapshot)
+                manifest = {"version": generation, "downloads": downloads,
+                            "change_seq": latest_change(snapshot),
+                            "schema_version": get_version(snapshot)}
+            finally:
+                snapshot.close()
+            manifest["sha256"] = file_checksum(temp)
+            manifest["size"] = os.path.getsize(temp)
+            manifest["published"] = int(time.time())
+            manifest["file"] = "catalog-%d-%s.sql" % (manifest["version"], manifest["sha256"][:16])
+            os.replace(temp, os.path.join(directory, manifest["file"]))
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        _write_manifest(directory, manifest)
+        _prune(directory, keep)
+        return manifest
+
+
+class Publisher:
+    """Publishes snapshots from each primary worker
+
+    A background thread publishes whenever notify() is called, after an
+    admin write, and otherwise checks for changes, like download counts,
+    every `interval' seconds.
+    """
+    def __init__(self, database, directory, interval=30.0, keep=3):
+        self.database = database
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._start = PerProcess(self._start_thread, self._lock)
+
+    def start(self):
+        """Start the publishing thread, if this process doesn't have one yet
+
+        This only happens once a worker serves a request, never in the
+        uWSGI master.
+        """
+        self._start()
+
+    def _start_thread(self):
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="snapshot-publisher", daemon=True)
+        self._thread.start()
+
+    def notify(self):
+        """Publish as soon as possible"""
+        self.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                publish(self.database, self.directory, keep=self.keep)
+            except (sql.Error, OSError) as error:
+                print("Could not publish a catalog snapshot: %s" % (error), file=sys.stderr)
+
+
+class SnapshotDatabase(Database):
+    """Read-only Database over the newest snapshot in `directory'
+
+    A thread in each worker checks for a new snapshot every `check_interval'
+    seconds, and calls `on_swap' after moving to one. Every thread moves its
+    connection over the next time it gets it.
+    """
+    def __init__(self, directory, check_interval=1.0, on_query=None, on_swap=None, **options):
+        super().__init__(None, on_query=on_query, **options)
+        self.directory = directory
+        self.check_interval = check_interval
+        self.on_swap = on_swap
+        self.manifest = None
+        # The last snapshot that failed its checks, and the state of its file back then
+        self._rejected = None
+        self._watcher = PerProcess(self._start_watcher, self._lock)
+        self.refresh()
+
+    def open(self):
+        """Open a new connection to the current snapshot, that the caller
+        has to close
+
+        Snapshots never change once published, so SQLite is told not to
+        bother locking them.
+        """
+        db = sql.connect("file:%s?immutable=1" % (urllib.parse.quote(os.path.abspath(self.path))),
+                         uri=True, isolation_level=None, check_same_thread=False,
+                         cached_statements=self.options["cached_statements"],
+                         factory=sql.Connection if self.on_query is None else TimedConnection)
+        db.execute("PRAGMA mmap_size=%d" % (self.options["mmap_size"]))
+        db.execute("PRAGMA cache_size=%d" % (self.options["cache_size"]))
+        if self.on_query is not None:
+            db.on_query = self.on_query
+        return db
+
+    def get(self):
+        """Get this thread's connection, moving it to the current snapshot"""
+        self._check_fork()
+        db = getattr(self._local, "db", None)
+        if db is not None and self._local.path != self.path:
+            with self._lock:
+                self._connections.remove(db)
+            db.close()
+            self._local.db = None
+        if getattr(self._local, "db", None) is None:
+            self._local.path = self.path
+        return super().get()
+
+    def refresh(self):
+        """Move to the newest snapshot, if it is new and checks out
+
+        Returns True if it moved.
+        """
+        manifest = read_manifest(self.directory)
+        if manifest is None or (self.manifest is not None and
+                                manifest["sha256"] == self.manifest["sha256"]):
+            return False
+        path = os.path.join(self.directory, manifest["file"])
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        # Only check a rejected snapshot again once its file changes, such as
+        # when it has finished syncing
+        state = (manifest["sha256"], stat.st_size, stat.st_mtime_ns)
+        if state == self._rejected:
+            return False
+        if manifest.get("schema_version") != SCHEMA_VERSION:
+            print("Snapshot %s has schema version %s, not %d. Not using it." %
+                  (manifest["file"], manifest.get("schema_version"), SCHEMA_VERSION), file=sys.stderr)
+            self._rejected = state
+            return False
+        if stat.st_size != manifest["size"] or file_checksum(path) != manifest["sha256"]:
+            print("Snapshot %s doesn't match its checksum. Not using it until it changes." %
+                  (manifest["file"]), file=sys.stderr)
+            self._rejected = state
+            return False
+        self.path = path
+        self.manifest = manifest
+        if self.on_swap is not None:
+            self.on_swap()
+        return True
+
+    def watch(self):
+        """Start checking for new snapshots, if this process isn't yet
+
+        Like the Publisher, this only happens once a worker serves a request.
+        """
+        self._watcher()
+
+    def _start_watcher(self):
+        threading.Thread(target=self._run, name="snapshot-watcher", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                self.refresh()
+            except (OSError, ValueError, KeyError) as error:
+                print("Could not check for a new catalog snapshot: %s" % (error), file=sys.stderr)
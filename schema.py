@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  schema.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""DB schema and migrations
+
+The schema version is kept in PRAGMA user_version. Every migration moves the
+DB up by one version, inside its own transaction, so a failed migration
+leaves the DB as it was. Never edit a migration once it has shipped: add a
+new one instead.
+"""
+import sys
+import sqlite3 as sql
+
+
+# Columns of the games table, in the order Game() takes them
+GAME_COLUMNS = """name, submitter, base64, downloads, genres, url, screenshots_url,
+description, rating, platform, add_time, in_pack_man"""
+
+
+def has_fts5(db):
+    """Check if this SQLite build has FTS5 compiled in"""
+    try:
+        return bool(db.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')").fetchone()[0])
+    except sql.Error:
+        return False
+
+
+def has_fulltext(db):
+    """Check if the full-text index exists"""
+    return db.execute("""SELECT name FROM sqlite_master
+    WHERE type='table' AND name='games_fts'""").fetchall() != []
+
+
+def tag_rows(game_id, genres, rating, platform):
+    """Get the game_tags rows for one game
+
+    Ratings and platforms are normalized the same way Game() does it.
+    """
+    rows = [(game_id, "genre", each) for each in (genres or "").split(",") if each != ""]
+    if rating:
+        rows.append((game_id, "rating", rating.upper()))
+    if platform:
+        rows.append((game_id, "platform", platform.lower()))
+    return rows
+
+
+def index_game_tags(db, game_id, genres, rating, platform):
+    """Add a newly inserted game to the tag index
+
+    Rows are added from Python, since splitting the genres list is not
+    something a trigger can do, and removed by a trigger on delete.
+    """
+    db.executemany("INSERT OR IGNORE INTO game_tags VALUES (?, ?, ?)",
+                   tag_rows(game_id, genres, rating, platform))
+
+
+class MigrationError(Exception):
+    """The DB has data a migration can't carry over without an admin's help"""
+
+
+def _legacy_schema(db):
+    """Version 1: the schema as it was before migrations existed
+
+    Older deployments already have some or all of this.
+    """
+    db.execute("""CREATE TABLE IF NOT EXISTS games
+    (name TEXT, submitter TEXT, base64 BLOB, downloads INTEGER, genres TEXT, url BLOB,
+    screenshots_url BLOB, description TEXT, rating TEXT, platform TEXT,
+    add_time INTEGER, in_pack_man BOOLEAN)""")
+    db.execute("""CREATE TABLE IF NOT EXISTS catalog_meta
+    (key TEXT PRIMARY KEY, value INTEGER)""")
+    db.execute("INSERT OR IGNORE INTO catalog_meta VALUES ('generation', 0)")
+    exists = db.execute("""SELECT name FROM sqlite_master
+    WHERE type='table' AND name='game_tags'""").fetchall()
+    db.execute("""CREATE TABLE IF NOT EXISTS game_tags
+    (game_id INTEGER NOT NULL, kind TEXT NOT NULL, tag TEXT NOT NULL,
+    UNIQUE (kind, tag, game_id))""")
+    db.execute("CREATE INDEX IF NOT EXISTS game_tags_tag ON game_tags (tag, game_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS game_tags_game ON game_tags (game_id)")
+    if not exists:
+        for each in db.execute("SELECT rowid, genres, rating, platform FROM games ORDER BY rowid").fetchall():
+            index_game_tags(db, *each)
+    if has_fts5(db):
+        exists = db.execute("""SELECT name FROM sqlite_master
+        WHERE type='table' AND name='games_fts'""").fetchall()
+        db.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS games_fts USING fts5
+        (name, description, content='games', content_rowid='rowid',
+        tokenize='unicode61 remove_diacritics 2')""")
+        if not exists:
+            db.execute("INSERT INTO games_fts (games_fts) VALUES ('rebuild')")
+
+
+def _integer_keys(db):
+    """Version 2: integer primary key, unique indexes and real column types
+
+    Row IDs are kept as the new primary key, so the tag and full-text indexes
+    stay valid. Games with a name that an older game already has get a
+    numbered suffix. Games without a name or download URL, or with the same
+    download URL as another game, stop the migration, since there is no way
+    to tell which one to keep.
+    """
+    conflicts = db.execute("""SELECT rowid, name, CAST(url AS TEXT) FROM games
+    WHERE name IS NULL OR base64 IS NULL OR CAST(base64 AS TEXT) IN
+    (SELECT CAST(base64 AS TEXT) FROM games GROUP BY 1 HAVING COUNT(*) > 1)
+    ORDER BY rowid""").fetchall()
+    if conflicts != []:
+        raise MigrationError("These games have no name or download URL, or share one. Please fix or "
+                             "remove them and retry:\n" +
+                             "\n".join(["row %d: name %r, URL %r" % each for each in conflicts]))
+    rows = db.execute("SELECT rowid, name FROM games ORDER BY rowid").fetchall()
+    taken = set([name for rowid, name in rows])
+    seen = set()
+    for rowid, name in rows:
+        if name in seen:
+            count = 2
+            while "%s_%d" % (name, count) in taken:
+                count += 1
+            new_name = "%s_%d" % (name, count)
+            taken.add(new_name)
+            db.execute("UPDATE games SET name = ? WHERE rowid = ?", (new_name, rowid))
+            print("Renamed game %d from %s to %s, since an older game has that name"
+                  % (rowid, name, new_name), file=sys.stderr)
+        seen.add(name)
+    db.execute("""CREATE TABLE games_new
+    (id INTEGER PRIMARY KEY, name TEXT NOT NULL, submitter TEXT,
+    base64 TEXT NOT NULL, downloads INTEGER NOT NULL DEFAULT 0, genres TEXT,
+    url TEXT, screenshots_url TEXT, description TEXT, rating TEXT,
+    platform TEXT, add_time INTEGER NOT NULL DEFAULT 0,
+    in_pack_man BOOLEAN NOT NULL DEFAULT 0 CHECK (in_pack_man IN (0, 1)))""")
+    db.execute("CREATE UNIQUE INDEX games_name ON games_new (name)")
+    db.execute("CREATE UNIQUE INDEX games_base64 ON games_new (base64)")
+    db.execute("""INSERT INTO games_new (id, %s)
+    SELECT rowid, name, submitter, CAST(base64 AS TEXT), COALESCE(downloads, 0),
+    genres, CAST(url AS TEXT), CAST(screenshots_url AS TEXT), description,
+    rating, platform, CAST(COALESCE(add_time, 0) AS INTEGER),
+    in_pack_man IN (1, '1', 'True', 'true')
+    FROM games ORDER BY rowid""" % (GAME_COLUMNS))
+    # Dropping the old table takes its triggers with it
+    db.execute("DROP TABLE games")
+    db.execute("ALTER TABLE games_new RENAME TO games")
+    db.execute("DELETE FROM game_tags WHERE game_id NOT IN (SELECT id FROM games)")
+    db.execute("""CREATE TRIGGER game_tags_delete AFTER DELETE ON games BEGIN
+    DELETE FROM game_tags WHERE game_id = old.id;
+    END""")
+    if has_fts5(db):
+        db.execute("DROP TABLE IF EXISTS games_fts")
+        db.execute("""CREATE VIRTUAL TABLE games_fts USING fts5
+        (name, description, content='games', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2')""")
+        db.execute("INSERT INTO games_fts (games_fts) VALUES ('rebuild')")
+        db.execute("""CREATE TRIGGER games_fts_insert AFTER INSERT ON games BEGIN
+        INSERT INTO games_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+        END""")
+        db.execute("""CREATE TRIGGER games_fts_delete AFTER DELETE ON games BEGIN
+        INSERT INTO games_fts (games_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        END""")
+        db.execute("""CREATE TRIGGER games_fts_update AFTER UPDATE OF name, description ON games BEGIN
+        INSERT INTO games_fts (games_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO games_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+        END""")
+    db.execute("UPDATE catalog_meta SET value = value + 1 WHERE key='generation'")
+
+
+def _submitter_index(db):
+    """Version 3: index on submitter, for the admin UI's per-submitter searches"""
+    db.execute("CREATE INDEX games_submitter ON games (submitter)")
+
+
+def _link_checks(db):
+    """Version 4: cached results of the link checker"""
+    db.execute("""CREATE TABLE link_checks
+    (url TEXT PRIMARY KEY, status INTEGER, error TEXT, checked INTEGER NOT NULL)""")
+
+
+def _change_log(db):
+    """Version 5: change log of the games table, for /games/changes
+
+    Every game already in the DB is logged as an insert, so syncing from 0
+    gets the whole catalog. Updates log the game's old name, and deletes the
+    name it had, so clients can tell which names went away. Each new event
+    drops whatever has fallen out of the newest change_log_size events.
+    """
+    db.execute("""CREATE TABLE game_changes
+    (seq INTEGER PRIMARY KEY AUTOINCREMENT, game_id INTEGER NOT NULL,
+    change TEXT NOT NULL CHECK (change IN ('insert', 'update', 'delete')), name TEXT NOT NULL)""")
+    db.execute("INSERT OR IGNORE INTO catalog_meta VALUES ('change_log_size', 100000)")
+    db.execute("""INSERT INTO game_changes (game_id, change, name)
+    SELECT id, 'insert', name FROM games ORDER BY id""")
+    db.execute("""CREATE TRIGGER game_changes_insert AFTER INSERT ON games BEGIN
+    INSERT INTO game_changes (game_id, change, name) VALUES (new.id, 'insert', new.name);
+    END""")
+    db.execute("""CREATE TRIGGER game_changes_update AFTER UPDATE ON games BEGIN
+    INSERT INTO game_changes (game_id, change, name) VALUES (new.id, 'update', old.name);
+    END""")
+    db.execute("""CREATE TRIGGER game_changes_delete AFTER DELETE ON games BEGIN
+    INSERT INTO game_changes (game_id, change, name) VALUES (old.id, 'delete', old.name);
+    END""")
+    db.execute("""CREATE TRIGGER game_changes_trim AFTER INSERT ON game_changes BEGIN
+    DELETE FROM game_changes WHERE seq <= new.seq -
+    (SELECT value FROM catalog_meta WHERE key='change_log_size');
+    END""")
+
+
+def _downloads_version(db):
+    """Version 6: a counter for download count flushes, kept apart from the
+    catalog generation so they don't make every worker rebuild its snapshot
+    """
+    db.execute("INSERT OR IGNORE INTO catalog_meta VALUES ('downloads', 0)")
+
+
+MIGRATIONS = [_legacy_schema, _integer_keys, _submitter_index, _link_checks, _change_log,
+              _downloads_version]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_version(db):
+    """Get the schema version of the DB"""
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(db):
+    """Bring the DB up to the latest schema version
+
+    Returns True if the DB had no games table at all beforehand.
+    """
+    fresh = db.execute("""SELECT name FROM sqlite_master
+    WHERE type='table' AND name='games'""").fetchall() == []
+    while True:
+        # IMMEDIATE, so no other process can migrate at the same time
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            version = get_version(db)
+            if version >= len(MIGRATIONS):
+                db.rollback()
+                break
+            MIGRATIONS[version](db)
+            db.execute("PRAGMA user_version = %d" % (version + 1))
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+    return fresh
+
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  search_cache.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Per-worker cache of search results
+
+Results are kept as the IDs of the games found, and free-text snippets, so
+a cached search is resolved against the current catalog snapshot, with its
+current download counts. Searches are keyed on what they mean rather than
+how they were typed: tags in any order, and text in any case or spacing,
+all share an entry. Results are kept whatever page was asked for, so every
+page of a search shares one entry too. Encoded response bodies can be kept
+alongside them, keyed on the download counts they show as well.
+
+Entries are dropped whenever the catalog's search version changes, which
+only happens when something a search looks at does, and not when download
+counts do. Otherwise the least recently used are dropped to stay within a
+byte budget, and any older than the TTL are searched for again.
+"""
+import sys
+import time
+import array
+import threading
+import collections
+from search_index import fulltext_query
+
+
+# Rough size of an entry, other than its IDs and snippets, or its body
+ENTRY_OVERHEAD = 200
+
+
+def tags_key(tags, match_all=False):
+    """Get the cache key of a tag search"""
+    return ("tags", tuple(sorted(set(tags))), bool(match_all))
+
+
+def text_key(text):
+    """Get the cache key of a full-text search, which ignores case and
+    anything between words
+    """
+    return ("free-text", fulltext_query(text.lower()))
+
+
+def substring_key(text):
+    """Get the cache key of a substring search, for SQLite without FTS5"""
+    return ("substring", text.lower())
+
+
+def entry_size(value):
+    """Estimate the memory a cached value takes
+
+    A value is either an EncodedBody, or the (IDs, snippets) of a search.
+    Bodies are counted by their uncompressed size, though they also keep
+    any compressed copies they are asked for.
+    """
+    if hasattr(value, "body"):
+        return ENTRY_OVERHEAD + len(value.body("identity"))
+    ids, snippets = value
+    size = ENTRY_OVERHEAD + sys.getsizeof(ids)
+    if snippets is not None:
+        size += sum(sys.getsizeof(each) for each in snippets) + sys.getsizeof(snippets)
+    return size
+
+
+class SearchCache:
+    """Search results, for a total of at most `max_bytes', kept for at most
+    `ttl' seconds
+    """
+    def __init__(self, max_bytes=8388608, ttl=600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.version = None
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hit": 0, "miss": 0, "evicted": 0}
+
+    def _drop(self, key):
+        """Drop an entry, with the lock held"""
+        value, size, stored = self._entries.pop(key)
+        self.size -= size
+
+    def get(self, version, key, search):
+        """Get the (IDs, snippets) of the games a search finds
+
+        `search' is only called when there is no cached result for `key' at
+        this search `version'. It returns the IDs of the games found, in
+        order, and either their snippets, or None.
+        """
+        def run():
+            ids, snippets = search()
+            return array.array("q", ids), None if snippets is None else tuple(snippets)
+        return self.get_value(version, key, run)
+
+    def get_value(self, version, key, build):
+        """Get any value for `key' at this search `version', calling build()
+        to make it if there is none cached
+        """
+        now = time.monotonic()
+        with self._lock:
+            if version != self.version:
+                self._entries.clear()
+                self.size = 0
+                self.version = version
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[2] < self.ttl:
+                self._entries.move_to_end(key)
+                self.stats["hit"] += 1
+                return entry[0]
+            self.stats["miss"] += 1
+        value = build()
+        size = entry_size(value)
+        with self._lock:
+            # Results of an older version than the cache's are not worth keeping
+            if version != self.version or size > self.max_bytes:
+                return value
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (value, size, now)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.stats["evicted"] += 1
+        return value
+
+    def get_stats(self):
+        """Get the hit, miss and eviction counts, and how many entries and
+        bytes are cached
+        """
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self.size
+        return stats
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  search_index.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Search indexes kept alongside the games table"""
+import re
+from games import COLUMNS, select_games
+
+
+# Game names weigh more than their descriptions when ranking
+NAME_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 1.0
+SNIPPET_TOKENS = 16
+# Anything that is not a letter or digit splits terms, same as the tokenizer
+TERM_SPLIT = re.compile(r"[\W_]+")
+# The games columns, for queries joining other tables that share their names
+JOINED_COLUMNS = ", ".join(["games." + each.strip() for each in COLUMNS.split(",")])
+# Tag kinds, and what /tags calls them
+TAG_KINDS = {"genre": "genres", "rating": "ratings", "platform": "platforms"}
+
+
+def fulltext_query(text):
+    """Turn free text into an FTS5 query
+
+    Every word must match, and the last word of the text only has to match
+    the start of a word so partially typed text still finds games. Words are
+    quoted so nothing the user types is treated as query syntax.
+    """
+    terms = [each for each in TERM_SPLIT.split(text) if each != ""]
+    if terms == []:
+        return None
+    terms = ['"%s"' % (each) for each in terms]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def fulltext_search(db, text, limit=-1, offset=0):
+    """Search game names and descriptions, best matches first
+
+    Returns Games, with a highlighted snippet of the description.
+    """
+    query = fulltext_query(text)
+    if query is None:
+        return []
+    return select_games(db, """SELECT %s,
+    snippet(games_fts, 1, '<b>', '</b>', '...', %d)
+    FROM games_fts JOIN games ON games.id = games_fts.rowid
+    WHERE games_fts MATCH ?
+    ORDER BY bm25(games_fts, %s, %s)
+    LIMIT ? OFFSET ?""" % (JOINED_COLUMNS, SNIPPET_TOKENS, NAME_WEIGHT, DESCRIPTION_WEIGHT),
+                        (query, limit, offset)).fetchall()
+
+
+def tag_filter(tags, match_all=False):
+    """Get a subquery, and its parameters, for the IDs of games with any, or
+    all, of the given tags
+
+    A tag matches a game's genres, rating or platform.
+    """
+    tags = list(dict.fromkeys(tags))
+    marks = ",".join(["?"] * len(tags))
+    if match_all:
+        return ("""SELECT game_id FROM game_tags WHERE tag IN (%s)
+        GROUP BY game_id HAVING COUNT(DISTINCT tag) = ?""" % (marks), tags + [len(tags)])
+    return "SELECT game_id FROM game_tags WHERE tag IN (%s)" % (marks), tags
+
+
+def tag_search(db, tags, match_all=False, limit=-1, offset=0):
+    """Find games with any, or all, of the given tags
+
+    Returns Games in table order.
+    """
+    games, params = tag_filter(tags, match_all)
+    return select_games(db, """SELECT %s FROM games WHERE id IN (%s)
+    ORDER BY id LIMIT ? OFFSET ?""" % (COLUMNS, games), params + [limit, offset]).fetchall()
+
+
+def admin_search(db, kind, text, submitter=None, fulltext=True):
+    """Find Games for the admin UI
+
+    `kind' is "tags", "free-text" or "submitter". If `submitter' is given,
+    only their games are searched. Empty text finds every game in scope.
+    """
+    scope, params = "", []
+    if submitter is not None:
+        scope, params = " AND games.submitter = ?", [submitter]
+    if kind == "tags" and text != "":
+        games, tag_params = tag_filter(text.split(","))
+        return select_games(db, """SELECT %s FROM games WHERE id IN (%s)%s
+        ORDER BY id""" % (COLUMNS, games, scope), tag_params + params).fetchall()
+    if kind == "submitter":
+        return select_games(db, """SELECT %s FROM games WHERE submitter = ?%s
+        ORDER BY id""" % (COLUMNS, scope), [text] + params).fetchall()
+    if kind == "free-text" and text != "" and fulltext:
+        query = fulltext_query(text)
+        if query is None:
+            return []
+        return select_games(db, """SELECT %s
+        FROM games_fts JOIN games ON games.id = games_fts.rowid
+        WHERE games_fts MATCH ?%s ORDER BY bm25(games_fts, %s, %s)""" % (JOINED_COLUMNS, scope,
+                                                                           NAME_WEIGHT,
+                                                                           DESCRIPTION_WEIGHT),
+                            [query] + params).fetchall()
+    if kind == "free-text" and text != "":
+        pattern = "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        return select_games(db, """SELECT %s FROM games
+        WHERE (name LIKE ? ESCAPE '\\' OR description LIKE ? ESCAPE '\\')%s
+        ORDER BY id""" % (COLUMNS, scope), [pattern, pattern] + params).fetchall()
+    return select_games(db, "SELECT %s FROM games WHERE 1%s ORDER BY id" % (COLUMNS, scope),
+                        params).fetchall()
+
+
+def tag_counts(db):
+    """Count the games for every tag, with a single aggregate query
+
+    Tags of each kind are listed in the order they first show up in the
+    catalog.
+    """
+    output = {each: {} for each in TAG_KINDS.values()}
+    for kind, tag, count in db.execute("""SELECT kind, tag, COUNT(*) FROM game_tags
+    GROUP BY kind, tag ORDER BY MIN(rowid)"""):
+        output[TAG_KINDS[kind]][tag] = count
+    return output
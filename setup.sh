@@ -30,13 +30,18 @@ fi
 echo "Installing Dependencies . . ."
 sudo apt install --assume-yes $(<requirements.txt)
 username=$(whoami)
+echo "Setting up the database . . ."
+FLASK_APP=store python3 -m flask init-db
 echo "Configuring your system . . ."
 sudo cp -v store_backend.nginx_conf /etc/nginx/sites-available/store_backend.conf
 sudo cp -v store_backend.service /etc/systemd/system/store_backend.service
+sudo cp -v store_links.service store_links.timer /etc/systemd/system/
 sudo sed -i "s:<path to>:$PWD:g" /etc/nginx/sites-available/store_backend.conf
 sudo sed -i "s:<port>:$port:g" /etc/nginx/sites-available/store_backend.conf
 sudo sed -i "s:<path to>:$PWD:g" /etc/systemd/system/store_backend.service
 sudo sed -i "s:<username>:$username:g" /etc/systemd/system/store_backend.service
+sudo sed -i "s:<path to>:$PWD:g" /etc/systemd/system/store_links.service
+sudo sed -i "s:<username>:$username:g" /etc/systemd/system/store_links.service
 
 # Only bother trying to delete this file if it exists
 if [ -f /etc/nginx/sites-enabled/default ]; then
@@ -49,5 +54,7 @@ sudo systemctl enable store_backend
 sudo ln -sv /etc/nginx/sites-available/store_backend.conf /etc/nginx/sites-enabled/store_backend.conf
 sudo systemctl restart nginx
 sudo systemctl start store_backend
+sudo systemctl daemon-reload
+sudo systemctl enable --now store_links.timer
 git log | grep "^commit " | head -n1 | awk '{print $2}' > .git_commit_number
 echo "Please ensure port $port is open so that the Vetala Store Backend may be exposed to the network"
@@ -28,12 +28,32 @@ import json
 import os
 import base64
 import time
-import copy
-import random
+import hmac
+import secrets
+import threading
+import urllib.parse
 import hashlib as hash
 import sqlite3 as sql
-from flask import Flask, request, render_template, redirect, url_for, flash
+import click
+from jinja2 import FileSystemBytecodeCache
+from flask import Flask, Response, request, render_template, redirect, url_for, flash
 from flask_login import login_user, login_required, current_user, logout_user, UserMixin, LoginManager
+from database import Database
+from metrics import Metrics
+from ratelimit import RateLimiter
+from credentials import open_store
+from passwords import PasswordHasher, Busy, KDFS
+from downloads import DownloadCounter, DownloadForwarder
+from catalog import Catalog, EncodedBody, CODING_SUFFIXES, bump_generation, encode_json, keyed, encode_keyed, brotli
+from paging import parse_fields, list_games, tag_page, text_page, export_games
+from schema import GAME_COLUMNS, SCHEMA_VERSION, MigrationError, migrate, get_version, has_fulltext, index_game_tags
+from games import RESERVED_NAMES, reserved_games
+from bulk import read_games, import_games, export_records, delete_games
+from search_index import fulltext_search, tag_search, admin_search
+from search_cache import SearchCache, tags_key, text_key, substring_key
+from links import LinkChecker, broken_links
+from changes import Resync, changes_since, set_log_size
+from replication import Publisher, SnapshotDatabase, publish
 
 
 def __eprint__(*args, **kwargs):
@@ -41,31 +61,23 @@ def __eprint__(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
-def gen_rand_string(length=16):
-    string = []
-    for each in range(length):
-        add = random.randint(33, 1000)
-        if random.randint(0, 1000) % 1.85:
-            string.append(chr(add))
-        else:
-            string.append(str(add))
-    return "".join(string)
-
-
-
 if sys.version_info[0] == 2:
     __eprint__("Please run with Python 3 as Python 2 is End-of-Life.")
     exit(2)
 
 app = Flask(__name__)
-if not os.path.isfile("settings.json"):
-    __eprint__("Settings file not present. Please make a settings file and retry.")
-    sys.exit(1)
-with open("settings.json", "r") as file:
-    settings = json.load(file)
-
-with open(settings["secrets_file"], "r") as file:
-    secrets = json.load(file)
+# Set up by create_app()
+settings = None
+credentials = None
+passwords = None
+metrics = None
+database = None
+fulltext = False
+catalog = None
+downloads = None
+publisher = None
+search_cache = None
+_init_lock = threading.Lock()
 
 
 class User(UserMixin):
@@ -77,68 +89,183 @@ class User(UserMixin):
         return self.username
 
 
-def get_users():
-    """Get list of all users"""
-    with open(settings["secrets_file"], "r") as file:
-        secrets = json.load(file)
-    users = {}
-    for each in secrets:
-        if isinstance(secrets[each], dict):
-            users[each] = User(each, secrets[each]["password_hash"])
-    return users
-
-
-# Initialize the DB
-db = sql.connect(settings["db_name"])
-tables = db.execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall()
-if len(tables) < 1:
-    db.execute("""CREATE TABLE games
-    (name TEXT, submitter TEXT, base64 BLOB, downloads INTEGER, genres TEXT, url BLOB,
-    screenshots_url BLOB, description TEXT, rating TEXT, platform TEXT,
-    add_time INTEGER, in_pack_man BOOLEAN)""")
-    if os.path.isfile("default_games.json"):
-        with open("default_games.json", "r") as file:
-            default_games = json.load(file)
-        for each in default_games:
-            db.execute("""INSERT INTO games VALUES
-("%s", "%s", "%s", %s, "%s", "%s", "%s", "%s",
-"%s", "%s", %s, %s)""" % (default_games[each]["Name"],
-                          default_games[each]["submitter"],
-                          default_games[each]["base64"],
-                          default_games[each]["downloads"],
-                          ",".join(default_games[each]["genres"]),
-                          default_games[each]["URL"],
-                          default_games[each]["screenshots_url"],
-                          default_games[each]["description"],
-                          default_games[each]["rating"],
-                          default_games[each]["platform"],
-                          default_games[each]["joined"],
-                          default_games[each]["in_pack_man"]))
-    db.commit()
-db.close()
-
-# Initalize Flask
-# Generate a random, alpha numeric key. With optional salting.
-key = gen_rand_string(length=secrets["secret_key_len"]) + secrets["salt"]
-app.config["SECRET_KEY"] = hash.sha512(key.encode()).hexdigest()
-# For security purposes, delete the pre-hashed version of the key and the secrets data struct
-del key, secrets
-
-
-def format_data(to_format):
-    return_data = {}
-    length = 0
-    for data in to_format:
-
-        add = {"Name": data[0], "submitter": data[1], "base64": data[2],
-               "downloads": data[3], "genres": data[4].split(","),
-               "URL": data[5], "screenshots_url": data[6],
-               "description": data[7], "rating": data[8].upper(),
-               "platform": data[9].lower(), "joined": data[10],
-               "in_pack_man": data[11]}
-        return_data[length] = copy.deepcopy(add)
-        length+=1
-    return return_data
+def get_user(username):
+    """Get a user, or None if they don't exist"""
+    record = credentials.get_user(username)
+    if record is None:
+        return None
+    return User(username, record["password_hash"])
+
+
+def load_settings(path="settings.json"):
+    """Read the settings file, exiting if there isn't one"""
+    if not os.path.isfile(path):
+        __eprint__("Settings file not present. Please make a settings file and retry.")
+        sys.exit(1)
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def secret_key(store):
+    """Get the secret key from the secrets file, making and saving one there
+    if it doesn't have one yet
+
+    Every worker, and every restart, signs sessions with the same key, so
+    logins stay valid whichever worker serves them.
+    """
+    return store.setdefault("secret_key", secrets.token_hex(32))
+
+
+def init_db(config):
+    """Create the DB, or bring it up to the latest schema, and make the
+    secret key if there isn't one yet
+
+    A new DB is seeded with default_games.json. Returns whether the DB was
+    new, and the schema version it had beforehand.
+    """
+    setup = Database(config["db_name"], **config.get("sqlite", {}))
+    try:
+        version = get_version(setup.get())
+        fresh = migrate(setup.get())
+        with setup.transaction() as db:
+            set_log_size(db, config.get("change_log_size", 100000))
+            hidden = reserved_games(db)
+        if fresh and os.path.isfile("default_games.json"):
+            with open("default_games.json", "r") as file:
+                import_games(setup, read_games(file))
+    finally:
+        setup.close()
+    if hidden != []:
+        __eprint__("These games can't be viewed or downloaded, since API routes have their names. "
+                   "Please rename them: %s" % (", ".join(hidden)))
+    secret_key(open_store(config))
+    return fresh, version
+
+
+def create_app(settings_file="settings.json"):
+    """Set everything up, and get the app
+
+    Only the first call does anything, so it is safe to call from anywhere.
+    wsgi.py calls it on import, which uWSGI does once in the master, before
+    forking the workers, unless lazy-apps is on. The DB has to be set up
+    beforehand, with `FLASK_APP=store flask init-db'.
+    """
+    global settings, credentials, passwords, metrics, database, fulltext, catalog, downloads, publisher
+    global search_cache
+    with _init_lock:
+        if settings is not None:
+            return app
+        config = load_settings(settings_file)
+        credentials = open_store(config)
+        passwords = PasswordHasher(**config.get("password_hashing", {}))
+
+        metrics = Metrics(config.get("metrics_spool", "metrics"),
+                          interval=config.get("metrics_flush_interval", 5.0))
+        metrics.install(app)
+        limits = config.get("rate_limit", {})
+        if limits.get("enabled", False):
+            RateLimiter(limits.get("file", "/dev/shm/vetala-store-rate-limit"),
+                        limits.get("default", {"rate": 20, "burst": 40}), routes=limits.get("routes"),
+                        exempt=limits.get("exempt", ()), slots=limits.get("slots", 65536)).install(app)
+        replica = config.get("replica", {})
+        if config.get("mode", "primary") == "replica":
+            database = SnapshotDatabase(replica.get("directory", "snapshots"),
+                                        check_interval=replica.get("check_interval", 1.0),
+                                        on_query=metrics.on_query, **config.get("sqlite", {}))
+            if database.manifest is None:
+                __eprint__("No usable catalog snapshot in %s. Please publish one from the primary and retry."
+                           % (database.directory))
+                sys.exit(1)
+            if urllib.parse.urlsplit(replica.get("primary_url", "")).scheme not in ("http", "https"):
+                __eprint__("replica.primary_url is not set to the primary's http(s) address. Please set it and retry.")
+                sys.exit(1)
+            if config.get("replica_token", "") == "":
+                __eprint__("replica_token is not set. Please set it to the primary's replica_token and retry.")
+                sys.exit(1)
+        else:
+            database = Database(config["db_name"], on_query=metrics.on_query, **config.get("sqlite", {}))
+        if get_version(database.get()) < SCHEMA_VERSION:
+            __eprint__("The DB is missing or out of date. Please run `FLASK_APP=store flask init-db' and retry.")
+            sys.exit(1)
+        fulltext = has_fulltext(database.get())
+        if not fulltext:
+            __eprint__("SQLite was built without FTS5. Falling back to slow free-text search.")
+        # Workers open their own connections after the fork
+        database.close()
+
+        app.config["SECRET_KEY"] = secret_key(credentials)
+        app.add_url_rule("/" + config["login_path"], "login", login)
+
+        # Compile the admin templates once, here, so every worker inherits them, and
+        # keep the bytecode on disk so restarts don't have to compile them again
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(config.get("template_cache"))
+        for each in app.jinja_env.list_templates():
+            app.jinja_env.get_template(each)
+        # Static files are linked with a hash of their content, so they can be cached
+        # for as long as browsers like
+        app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 31536000
+        with open(os.path.join(app.static_folder, "admin.css"), "rb") as file:
+            app.jinja_env.globals["asset_version"] = hash.blake2b(file.read(), digest_size=8).hexdigest()
+
+        catalog = Catalog(database, check_interval=config.get("catalog_check_interval", 1.0),
+                          suggestion_size=config.get("max_suggestions", 20))
+        search_cache = SearchCache(max_bytes=config.get("search_cache_bytes", 8388608),
+                                   ttl=config.get("search_cache_ttl", 600))
+        if config.get("mode", "primary") == "replica":
+            database.on_swap = catalog.invalidate
+            app.before_request(database.watch)
+            app.before_request(replica_reads_only)
+            downloads = DownloadForwarder(replica.get("primary_url", ""), config.get("replica_token", ""),
+                                          interval=config.get("download_flush_interval", 5.0))
+        else:
+            downloads = DownloadCounter(database, interval=config.get("download_flush_interval", 5.0),
+                                        on_flush=catalog.invalidate)
+            if config.get("publish", {}).get("directory", "") != "":
+                publisher = Publisher(database, config["publish"]["directory"],
+                                      interval=config["publish"].get("interval", 30.0),
+                                      keep=config["publish"].get("keep", 3))
+                app.before_request(publisher.start)
+        metrics.add_collector(cache_metrics)
+        settings = config
+    return app
+
+
+# What a read-only replica serves
+REPLICA_ENDPOINTS = ("static", "front_page", "game_front_page", "export_catalog", "game_changes",
+                     "popular_games", "new_games", "view_game", "download_game", "serve_search",
+                     "get_tags", "suggest", "serve_metrics")
+
+
+def replica_reads_only():
+    """Turn away anything a replica can't do, like logging in"""
+    if request.endpoint is not None and request.endpoint not in REPLICA_ENDPOINTS:
+        return Response("This is a read-only replica. Please use the primary for that.\n", status=403,
+                        mimetype="text/plain")
+    return None
+
+
+def catalog_changed():
+    """Let this worker, and replicas, know an admin changed the catalog"""
+    catalog.invalidate()
+    if publisher is not None:
+        publisher.notify()
+
+
+def has_bearer_token(token):
+    """Check if the request carries `token' as a bearer token, if it is set"""
+    supplied = request.headers.get("Authorization", "")
+    return token != "" and hmac.compare_digest(supplied.encode(), ("Bearer " + token).encode())
+
+
+def cache_metrics():
+    """Get the catalog's cache hits and misses, for /metrics"""
+    stats = catalog.get_stats()
+    for result, count in search_cache.get_stats().items():
+        stats["search_" + result] = count
+    return [("vetala_cache_requests_total", (("cache", cache), ("result", result)),
+             stats["%s_%s" % (cache, result)])
+            for cache in ("snapshot", "encoded", "search") for result in ("hit", "miss")]
+
 
 
 login_manager = LoginManager()
@@ -149,7 +276,7 @@ login_manager.init_app(app)
 @login_manager.user_loader
 def load_user(username):
     # since the user_id is just the primary key of our user table, use it in the query for the user
-    return get_users()[username]
+    return get_user(username)
 
 
 @app.route("/")
@@ -160,129 +287,338 @@ We strongly advise that you use the official client to interact with this API.
 """ % (settings["store_name"])
 
 
+def pick_coding():
+    """Pick the best content coding the client accepts"""
+    if brotli is not None and request.accept_encodings["br"]:
+        return "br"
+    if request.accept_encodings["gzip"]:
+        return "gzip"
+    return "identity"
+
+
+def encoded_response(snapshot, key, build, cache=True):
+    """Serve pre-encoded JSON for `key', honoring If-None-Match"""
+    coding = pick_coding()
+    etag = snapshot.etag(key)
+    # Every coding of the same key is the same data, so any of them will do
+    if any(request.if_none_match.contains(etag + each) for each in CODING_SUFFIXES.values()):
+        response = Response(status=304)
+    else:
+        body = snapshot.encoded(key, build, cache=cache)
+        response = Response(body.body(coding), mimetype="application/json")
+        if coding != "identity":
+            response.headers["Content-Encoding"] = coding
+    response.set_etag(etag + CODING_SUFFIXES[coding])
+    response.headers["Cache-Control"] = "no-cache"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def page_size():
+    """Get the requested page size, within the configured maximum"""
+    size = settings.get("max_page_size", 100)
+    return min(max(request.args.get("limit", size, type=int), 1), size)
+
+
+def paged_response(fetch, snippet=False):
+    """Serve one page of games, with the cursor for the next one in a header
+
+    `fetch' is called with the fields, page size and cursor to get the page.
+    """
+    try:
+        fields = parse_fields(request.args.get("fields"), snippet=snippet)
+        data, next_cursor = fetch(fields, page_size(), request.args.get("cursor"))
+    except ValueError as error:
+        return {"Error": str(error)}
+    response = Response(encode_json(data), mimetype="application/json")
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
+
+
+@app.route("/games/export")
+def export_catalog():
+    try:
+        fields = parse_fields(request.args.get("fields"))
+    except ValueError as error:
+        return {"Error": str(error)}
+    # A connection of its own, since the stream outlives this function
+    return Response(export_games(database.open(), fields,
+                                 chunk_size=settings.get("export_chunk_size", 500)),
+                    mimetype="application/x-ndjson")
+
+
 @app.route("/games")
 def game_front_page():
-    db = sql.connect(settings["db_name"])
-    data = db.execute("SELECT * FROM games").fetchall()
-    data = format_data(data)
-    if data == {}:
-        return {}
-    for each in data:
-        del data[each]["URL"]
-        del data[each]["base64"]
-        del data[each]["in_pack_man"]
-        del data[each]["submitter"]
-    db.close()
-    return data
+    if request.accept_mimetypes.best == "application/x-ndjson":
+        return export_catalog()
+    if any(each in request.args for each in ("limit", "cursor", "fields")):
+        return paged_response(lambda fields, limit, cursor: list_games(database.get(), fields,
+                                                                        limit, cursor))
+    snapshot = catalog.get()
+    order = request.args.get("sort")
+    if order in ("popular", "new", "name"):
+        response = encoded_response(snapshot, "games:" + order, lambda: snapshot.ranked(order))
+    else:
+        response = encoded_response(snapshot, "games", lambda: encode_keyed(snapshot.games))
+    # Where to sync from with /games/changes
+    response.headers["X-Change-Seq"] = str(snapshot.change_seq)
+    return response
+
+
+@app.route("/games/changes")
+def game_changes():
+    """Get the games that changed since a change log event, and the names
+    that went away
+    """
+    since = request.args.get("since", type=int)
+    if since is None:
+        return {"Error": "Pass the `seq' of your last sync, or of your copy of /games, as `since'."}
+    snapshot = catalog.get()
+    if since > snapshot.change_seq:
+        # Another worker has served a newer catalog than ours
+        catalog.invalidate()
+        snapshot = catalog.get()
+
+    def build():
+        with database.transaction("DEFERRED") as db:
+            ids, names = changes_since(db, since, snapshot.change_seq)
+        games = sorted([snapshot.by_id[each] for each in ids if each in snapshot.by_id],
+                       key=lambda game: game.id)
+        return {"seq": snapshot.change_seq, "games": keyed(games),
+                "removed": sorted(names - snapshot.by_name.keys())}
+
+    try:
+        return encoded_response(snapshot, "changes:%d" % (since), build, cache=False)
+    except Resync as error:
+        return Response(encode_json({"Error": str(error), "resync": True,
+                                     "seq": snapshot.change_seq}),
+                        status=410, mimetype="application/json")
+
+
+def leaderboard_limit():
+    """Get the requested leaderboard length, within what we keep"""
+    size = settings.get("leaderboard_size", 100)
+    return min(max(request.args.get("limit", 20, type=int), 1), size)
+
+
+@app.route("/games/popular")
+def popular_games():
+    snapshot = catalog.get()
+    limit = leaderboard_limit()
+    if request.args.get("decay", "0") not in ("0", "false"):
+        # Decayed scores change with time, so let them go stale for an hour at most
+        key = "popular:%d:decay:%d" % (limit, time.time() // 3600)
+        return encoded_response(snapshot, key, lambda: snapshot.decayed(limit))
+    return encoded_response(snapshot, "popular:%d" % (limit),
+                            lambda: snapshot.ranked("popular", limit))
+
+
+@app.route("/games/new")
+def new_games():
+    snapshot = catalog.get()
+    limit = leaderboard_limit()
+    return encoded_response(snapshot, "new:%d" % (limit),
+                            lambda: snapshot.ranked("new", limit))
 
 
 # Looking at an individual game
 @app.route("/games/<name>")
 def view_game(name):
-    db = sql.connect(settings["db_name"])
-    data = db.execute("SELECT * FROM games WHERE name='%s'" % (name)).fetchall()
-    data = format_data(data)
-    if data == {}:
+    snapshot = catalog.get()
+    if name not in snapshot.by_name:
         return {}
-    del data[0]["URL"]
-    del data[0]["base64"]
-    del data[0]["in_pack_man"]
-    del data[0]["submitter"]
-    db.close()
-    return data[0]
+    return encoded_response(snapshot, "game:" + name, lambda: snapshot.by_name[name].public_json())
 
 
 # Download game
 @app.route("/games/<name>/download")
 def download_game(name):
-    db = sql.connect(settings["db_name"])
-    data = db.execute("SELECT * FROM games WHERE name='%s'" % (name))
-    return_data = format_data(data.fetchall())
-    db.execute("UPDATE games SET downloads = %s WHERE base64 = '%s'" % (return_data[0]["downloads"] + 1, return_data[0]["base64"]))
-    db.commit()
-    db.close()
-    return {"URL": return_data[0]["URL"], "in_pack_man": return_data[0]["in_pack_man"]}
+    snapshot = catalog.get()
+    game = snapshot.by_name.get(name)
+    if game is None:
+        return {}
+    # Counted in memory, and added to the DB in batches
+    downloads.record(game.id)
+    return {"URL": game.url, "in_pack_man": game.in_pack_man}
 
 
 # Searching for games
 @app.route("/search/<term>")
-def search(term, internal=False):
-    db = sql.connect(settings["db_name"])
+def serve_search(term):
+    if term[:4] != "tags" and term[:9] != "free-text":
+        return search(term)
+    match_all = request.args.get("match", "any") == "all"
+    if "cursor" in request.args or "fields" in request.args:
+        if term[:4] == "tags":
+            return paged_response(lambda fields, limit, cursor: tag_page(database.get(), term[5:].split(","),
+                                                                          fields, limit, cursor,
+                                                                          match_all=match_all))
+        if not fulltext:
+            return {"Error": "Free-text searches cannot be paged without FTS5."}
+        return paged_response(lambda fields, limit, cursor: text_page(database.get(), term[10:],
+                                                                       fields, limit, cursor),
+                              snippet=True)
+    limit = max(request.args.get("limit", -1, type=int), -1)
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    key = "search:%s:%s:%s:%s" % (term, limit, offset, match_all)
+    snapshot = catalog.get()
+    if term[:4] == "tags":
+        query = query_key("tags", term[5:], match_all)
+    else:
+        query = query_key("free-text", term[10:])
+    # Kept in the search cache rather than the snapshot, so there is a limit to how many
+    body_key = ("body", snapshot.version, query, limit, offset)
+
+    def build():
+        return EncodedBody(search(term, limit=limit, offset=offset, match_all=match_all))
+
+    return encoded_response(snapshot, key,
+                            lambda: search_cache.get_value(snapshot.search_version, body_key, build),
+                            cache=False)
+
+
+def search(term, limit=-1, offset=0, match_all=False):
     if term[:4] == "tags":
-        tags = term[5:].split(",")
-        return_data = {}
-        length = 0
-        data = format_data(db.execute("SELECT * FROM games").fetchall())
-        for game in data:
-            for tag in tags:
-                if ((tag in data[game]["genres"]) or (tag == data[game]["rating"]) or (tag == data[game]["platform"])):
-                    return_data[length] = data[game]
-                    length+=1
-                    break
+        found = find_games(catalog.get(), "tags", term[5:], match_all=match_all)
     elif term[:9] == "free-text":
-        text = term[10:]
-        return_data = {}
-        length = 0
-        data = format_data(db.execute("SELECT * FROM games").fetchall())
-        for game in data:
-            if ((text.lower() in data[game]["Name"].lower()) or (text.lower() in data[game]["description"].lower())):
-                return_data[length] = data[game]
-                length+=1
+        found = find_games(catalog.get(), "free-text", term[10:])
     else:
         return {"Error": "Not a valid search type. Valid types are 'tags' and 'free-text'."}
-    for each in return_data:
-        del return_data[each]["URL"]
-        if not internal:
-            del return_data[each]["base64"]
-            del return_data[each]["submitter"]
-        del return_data[each]["in_pack_man"]
-    db.close()
-    return return_data
+    found = found[offset:]
+    if limit >= 0:
+        found = found[:limit]
+    return encode_keyed([game for game, snippet in found], [snippet for game, snippet in found])
+
+
+def query_key(kind, text, match_all=False):
+    """Get the search cache key of a search, as find_games() takes it"""
+    if kind == "tags":
+        return tags_key(text.split(","), match_all)
+    if fulltext:
+        return text_key(text)
+    return substring_key(text)
+
+
+def find_games(snapshot, kind, text, match_all=False):
+    """Get every game a search finds, as (Game, snippet) pairs, from the
+    search cache if it can
+
+    `kind' is "tags", for a comma delimited list of tags in `text', or
+    "free-text". Snippets are None, except for free-text searches with FTS5.
+    """
+    key = query_key(kind, text, match_all)
+    if kind == "tags":
+        def run():
+            return [game.id for game in tag_search(database.get(), key[1], match_all=match_all)], None
+    elif fulltext:
+        def run():
+            games = fulltext_search(database.get(), text.lower())
+            return [game.id for game in games], [game.snippet for game in games]
+    else:
+        def run():
+            return [game.id for game in snapshot.games
+                    if key[1] in game.name.lower() or key[1] in (game.description or "").lower()], None
+    ids, snippets = search_cache.get(snapshot.search_version, key, run)
+    if snippets is None:
+        snippets = [None] * len(ids)
+    # The DB can be a little ahead of the snapshot, so it may not have every game found yet
+    return [(snapshot.by_id[each], snippet) for each, snippet in zip(ids, snippets)
+            if each in snapshot.by_id]
 
 
 @app.route("/tags")
 def get_tags():
-    games = game_front_page()
-    output = {"genres": [], "ratings": [], "platforms": []}
-    for each in games:
-        for each1 in games[each]["genres"]:
-            if each1 not in output["genres"]:
-                output["genres"].append(each1)
-        if games[each]["rating"] not in output["ratings"]:
-            output["ratings"].append(games[each]["rating"])
-        if games[each]["platform"] not in output["platforms"]:
-            output["platforms"].append(games[each]["platform"])
-    return output
+    snapshot = catalog.get()
+    return encoded_response(snapshot, "tags", lambda: snapshot.tags)
+
+
+def suggestion_limit():
+    """Get the requested number of suggestions, within what we keep"""
+    size = settings.get("max_suggestions", 20)
+    return min(max(request.args.get("limit", 10, type=int), 1), size)
+
+
+# Type-ahead for search boxes
+@app.route("/suggest/<prefix>")
+def suggest(prefix):
+    snapshot = catalog.get()
+    limit = suggestion_limit()
+    # Suggestions are only cached for as long as this request needs them
+    return encoded_response(snapshot, "suggest:%d:%s" % (limit, prefix),
+                            lambda: {index: {"suggestion": label, "type": kind, "downloads": downloads}
+                                     for index, (kind, label, downloads) in
+                                     enumerate(catalog.suggest(prefix, limit))},
+                            cache=False)
+
+
+@app.route("/metrics")
+def serve_metrics():
+    """Prometheus metrics, merged across workers
+
+    Open to logged in admins, and to scrapers sending the configured
+    metrics_token as a bearer token.
+    """
+    if not (current_user.is_authenticated or has_bearer_token(settings.get("metrics_token", ""))):
+        return Response("Unauthorized\n", status=401, mimetype="text/plain",
+                        headers={"WWW-Authenticate": "Bearer"})
+    return Response(metrics.collect(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/replica/downloads", methods=["POST"])
+def replica_downloads():
+    """Add download counts forwarded by a replica, as an object of game IDs
+    to counts
+
+    Only open to replicas sending the replica_token as a bearer token.
+    """
+    if not has_bearer_token(settings.get("replica_token", "")):
+        return Response("Unauthorized\n", status=401, mimetype="text/plain",
+                        headers={"WWW-Authenticate": "Bearer"})
+    try:
+        counts = {int(game_id): int(count) for game_id, count in request.get_json(force=True).items()}
+    except (AttributeError, TypeError, ValueError):
+        return {"Error": "Expected an object of game IDs to download counts"}, 400
+    counts = {game_id: count for game_id, count in counts.items() if count > 0}
+    downloads.add(counts)
+    return {"added": sum(counts.values())}
 
 
 # Admin UI Section
-@app.route("/" + settings["login_path"])
+# Routed by create_app(), since the path comes from the settings file
 def login():
     return render_template("login.html")
 
 
 @app.route('/login', methods=['POST'])
 def login_post():
-    with open(settings["secrets_file"], "r") as file:
-        secrets = json.load(file)
     username = request.form.get("username")
-    gen_hash = request.form.get("password")
+    password = request.form.get("password")
     remember = True if request.form.get('remember') else False
-
-    # Check to see if the user exisits
-    if username in secrets:
-        # get their settings and hash their password
-        stored_hash = secrets[username]["password_hash"]
-        hash_func = getattr(hash, secrets[username]["hash_algo"].lower())
-        for each in range(secrets[username]['rehash_count']):
-            gen_hash = hash_func(gen_hash.encode()).hexdigest()
-
-    # Double check the user exists and that the hash matches
-    if ((username not in secrets) or (stored_hash != gen_hash)):
+    record = credentials.get_user(username)
+
+    # Check to see if the user exisits, and that the password matches
+    valid = outdated = False
+    try:
+        if record is not None:
+            valid, outdated = passwords.verify(record, password)
+    except Busy:
+        flash('Too many people are logging in right now. Please try again in a moment.')
+        return redirect(url_for("login"))
+    if not valid:
         flash('Please check your login details and try again.')
         return redirect(url_for("login"))
 
-    login_user(get_users()[username], remember=remember)
+    # Move accounts still on legacy or old settings over to the current ones
+    if outdated:
+        try:
+            record.update(passwords.make(password, kdf=record.get("kdf")))
+            credentials.update_user(username, **record)
+        except Busy:
+            pass
+    del password
+
+    login_user(User(username, record["password_hash"]), remember=remember)
     return redirect(url_for('home'))
 
 
@@ -302,44 +638,139 @@ def interface_ag():
 @app.route("/add_game", methods=["POST"])
 @login_required
 def add_game():
-    db = sql.connect(settings["db_name"])
     # We can get everything except the base64, time, and downloads from the form
     # The remaining 2 (base64 and time) we have to get ourselves
     # Downloads can be assumed to be 1
-    base64_val = base64.encodestring(request.form.get("URL").encode()).decode()
+    base64_val = base64.encodebytes(request.form.get("URL").encode()).decode()
     base64_val = base64_val.strip("\r")
     base64_val = base64_val.strip("\n")
     name = request.form.get("name").replace(" ", "_")
-    add = """VALUES ("%s", "%s", "%s", %s, "%s", "%s", "%s", "%s", "%s", "%s", %s, %s)""" % (name,
-                                                                                       current_user.username,
-                                                                                       base64_val,
-                                                                                       1, request.form.get("genres"),
-                                                                                       request.form.get("URL"),
-                                                                                       request.form.get("screenshots_url"),
-                                                                                       request.form.get("description"),
-                                                                                       request.form.get("rating").upper(),
-                                                                                       request.form.get("platform").lower(),
-                                                                                       time.time(),
-                                                                                       True if request.form.get('in_pack_man') else False)
-    command = """INSERT INTO games (name, submitter, base64, downloads, genres, url, screenshots_url, description, rating, platform, add_time, in_pack_man) %s """ % (add)
-    db.execute(command)
-    db.commit()
-    db.close()
-    temp = render_template("add_game.html")
-    place_holder = "<!-- ### -->"
-    added = "</br>" + name.replace("_", " ") + " Successfully Added!</br>"
-    temp = temp.replace(place_holder, added)
-    return temp
+    if name in RESERVED_NAMES:
+        return render_template("add_game.html", added="That name is reserved, please pick another!")
+    add = (name, current_user.username, base64_val, 1, request.form.get("genres"),
+           request.form.get("URL"), request.form.get("screenshots_url"),
+           request.form.get("description"), request.form.get("rating").upper(),
+           request.form.get("platform").lower(), int(time.time()),
+           True if request.form.get('in_pack_man') else False)
+    command = """INSERT INTO games (%s) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""" % (GAME_COLUMNS)
+    try:
+        with database.transaction() as db:
+            game_id = db.execute(command, add).lastrowid
+            index_game_tags(db, game_id, request.form.get("genres"), request.form.get("rating"),
+                            request.form.get("platform"))
+            bump_generation(db)
+        added = name.replace("_", " ") + " Successfully Added!"
+    except sql.IntegrityError:
+        added = "A game with that name or download URL already exists!"
+    catalog_changed()
+    return render_template("add_game.html", added=added)
+
+
+@app.route("/import_games", methods=["POST"])
+@login_required
+def bulk_import():
+    """Upsert games from a JSON or NDJSON request body"""
+    username = current_user.username
+    if limited_to(username) is not None:
+        return render_template("forbidden.html", username=username)
+    report = import_games(database, read_games(request.stream), submitter=username,
+                          resume=request.args.get("resume", 0, type=int),
+                          batch_size=request.args.get("batch_size", 0, type=int))
+    catalog_changed()
+    return report
+
+
+@app.route("/export_games")
+@login_required
+def bulk_export():
+    """Stream every game, in the format /import_games takes"""
+    username = current_user.username
+    if limited_to(username) is not None:
+        return render_template("forbidden.html", username=username)
+    ndjson = request.args.get("format", "ndjson") != "json"
+    # A connection of its own, since the stream outlives this function
+    return Response(export_records(database.open(), chunk_size=settings.get("export_chunk_size", 500),
+                                   ndjson=ndjson),
+                    mimetype="application/x-ndjson" if ndjson else "application/json")
+
+
+@app.cli.command("import-games")
+@click.argument("file", type=click.File("rb"))
+@click.option("--submitter", default="None", help="Submitter of games that don't name one.")
+@click.option("--resume", default=0, help="Record to start from, as reported by an earlier run.")
+@click.option("--batch-size", default=0,
+              help="Commit every N records, so an interrupted import can be resumed.")
+def import_games_command(file, submitter, resume, batch_size):
+    """Import games from a JSON or NDJSON FILE, or - for stdin"""
+    create_app()
+    report = import_games(database, read_games(file), submitter=submitter, resume=resume,
+                          batch_size=batch_size)
+    for each in report["errors"]:
+        click.echo("Record %d (%s): %s" % (each["record"], each["Name"], each["error"]), err=True)
+    click.echo("Imported %d game(s), %d failed" % (report["imported"], len(report["errors"])))
+    if "error" in report:
+        click.echo("%s. Run again with --resume %d to continue." % (report["error"], report["next"]),
+                   err=True)
+        sys.exit(1)
+
+
+@app.cli.command("export-games")
+@click.argument("file", type=click.File("wb"), default="-")
+@click.option("--json", "as_json", is_flag=True, help="Write one JSON object instead of NDJSON.")
+def export_games_command(file, as_json):
+    """Export every game to FILE, or stdout, in the import format"""
+    create_app()
+    for each in export_records(database.open(), chunk_size=settings.get("export_chunk_size", 500),
+                               ndjson=not as_json):
+        file.write(each)
+
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create the DB, or bring it up to date, and make the secret key"""
+    try:
+        fresh, version = init_db(load_settings())
+    except MigrationError as error:
+        click.echo(error, err=True)
+        sys.exit(1)
+    if fresh:
+        click.echo("Created the DB")
+    elif version < SCHEMA_VERSION:
+        click.echo("Migrated the DB from schema version %d to %d" % (version, SCHEMA_VERSION))
+    else:
+        click.echo("The DB is up to date")
+
+
+@app.cli.command("publish")
+def publish_command():
+    """Publish a catalog snapshot for replicas, if the newest one is out of date"""
+    create_app()
+    if settings.get("mode", "primary") == "replica":
+        click.echo("Replicas can't publish snapshots", err=True)
+        sys.exit(1)
+    options = settings.get("publish", {})
+    if options.get("directory", "") == "":
+        click.echo("Set publish.directory in the settings file first", err=True)
+        sys.exit(1)
+    manifest = publish(database, options["directory"], keep=options.get("keep", 3))
+    if manifest is None:
+        click.echo("The newest snapshot is up to date")
+    else:
+        click.echo("Published %s" % (manifest["file"]))
+
+
+@app.cli.command("check-links")
+def check_links_command():
+    """Check the download and screenshot links that are due for a check"""
+    create_app()
+    checked, broken = LinkChecker(database, **settings.get("link_check", {})).run()
+    click.echo("Checked %d link(s), %d broken" % (checked, broken))
 
 
 @app.route("/remove_game")
 @login_required
 def interface_rg():
-    temp = render_template("remove_game.html")
-    place_holder = "<!-- ### -->"
-    base64_vals = """<input type="hidden" id="base64_vals" name="base64_vals" value="">"""
-    temp = temp.replace(place_holder, base64_vals)
-    return temp
+    return render_template("remove_game.html", base64_vals="", search_term=None)
 
 
 @app.route("/remove_game", methods=["POST"])
@@ -349,10 +780,8 @@ def rg_post_toggle():
     search_button = request.form.get("search")
     if search_button is not None:
         return get_games_rg(search_button)
-    base64_vals = request.form.get("base64_vals").split(",")
-    for each in base64_vals:
-        each = each.strip("\r")
-        each = each.strip("\n")
+    base64_vals = [each.strip("\r").strip("\n") for each in
+                   request.form.get("base64_vals").split(",")]
     return remove_games(base64_vals, request.form)
 
 
@@ -362,81 +791,62 @@ def home():
     return render_template("home.html", username=current_user.username)
 
 
+@app.route("/link_report")
+@login_required
+def link_report():
+    """List games with broken links, as of the last link check"""
+    links = broken_links(database.get(), submitter=limited_to(current_user.username))
+    return render_template("link_report.html", links=links, time=time)
+
+
+def limited_to(username):
+    """Get the submitter a user's changes are limited to, or None if they
+    can change any game
+    """
+    if credentials.get_user(username)["removable"]:
+        return username
+    return None
+
+
 def get_games_rg(orig_search_term):
-    with open(settings["secrets_file"], "r") as file:
-        secrets = json.load(file)
-    user = current_user.username
-    limited = False
-    if secrets[user]["removable"]:
-        limited = True
-    del secrets
-    if orig_search_term[0] == "$":
-        search_term = "tags=" + orig_search_term[1:]
+    submitter = limited_to(current_user.username)
+    metrics.incr("vetala_admin_searches_total", (("scope", "all" if submitter is None else "own"),))
+    # $ searches tags, and @ searches by submitter
+    if orig_search_term[:1] == "$":
+        kind, search_term = "tags", orig_search_term[1:]
+    elif orig_search_term[:1] == "@":
+        kind, search_term = "submitter", orig_search_term[1:]
     else:
-        search_term = "free-text=" + orig_search_term
-    search_results = search(search_term, internal=True)
-    if limited:
-        print("LIMITED USER ACCESSING: %s" % (user))
-        working = {}
-        count = 0
-        for each in search_results:
-            if search_results[each]["submitter"] == user:
-                working[count] = search_results[each]
-                count += 1
-        search_results = working
-    temp = render_template("remove_game.html")
-    place_holder = "<!-- ### -->"
-    output = []
-    base64_output = []
-    # We have our search terms. We have our template. Now we need to generate the
-    # data to parse into the template
-    for each in search_results:
-        check_box = """
-            <div class="field">
-                <label class="checkbox">
-                    <input type="checkbox" name="%s">
-                    <!-- ### -->
-                </label>
-            </div>
-""" % (search_results[each]["base64"])
-        check_box = check_box.replace(place_holder, search_results[each]["Name"].replace("_", " "))
-        # Make sure replacing it later doesn't overwrite the copied value
-        output.append(copy.deepcopy(check_box))
-        base64_output.append(search_results[each]["base64"])
-    base64_vals = """<input type="hidden" id="base64_vals" name="base64_vals" value="%s">""" % (",".join(base64_output))
-    prev_search_term = """<input type="hidden" id="prev_search_term" name="prev_search_term" value="%s">""" % (orig_search_term)
-    output = "</br>".join(output)
-    output = base64_vals + prev_search_term + "</br>" + output
-    temp = temp.replace(place_holder, output)
-    return temp
+        kind, search_term = "free-text", orig_search_term
+    if (submitter is not None or kind == "submitter" or search_term == "" or
+            (kind == "free-text" and not fulltext)):
+        # Limited users only ever search their own games, in SQL
+        search_results = admin_search(database.get(), kind, search_term, submitter=submitter,
+                                      fulltext=fulltext)
+    else:
+        # Shares the search cache with /search
+        search_results = [game for game, snippet in find_games(catalog.get(), kind, search_term)]
+    return render_template("remove_game.html", games=search_results,
+                           base64_vals=",".join([each.base64 for each in search_results]),
+                           search_term=orig_search_term)
 
 
 def remove_games(base64_vals, form):
-    db = sql.connect(settings["db_name"])
-    deleted = []
-    delete_command = """DELETE FROM games WHERE base64=\""""
-    select_command = """SELECT * FROM games WHERE base64=\""""
-    place_holder = "<!-- ### -->"
-    temp = render_template("remove_game.html")
-    for each in base64_vals:
-        if form.get(each) == "on":
-            data = format_data(db.execute(select_command + each + "\"").fetchall())[0]
-            print(data)
-            deleted.append(data["Name"].replace("_", " "))
-            db.execute(delete_command + each + "\"")
-    db.commit()
-    deleted = "</br>" + ", ".join(deleted) + " Successfully Deleted!</br>"
-    temp = temp.replace(place_holder, deleted)
-    return temp
+    checked = [each for each in base64_vals if form.get(each) == "on"]
+    with database.transaction() as db:
+        deleted = delete_games(db, checked, submitter=limited_to(current_user.username))
+        if deleted != []:
+            bump_generation(db)
+    catalog_changed()
+    deleted = [each.replace("_", " ") for each in deleted]
+    deleted = ", ".join(deleted) + " Successfully Deleted!"
+    return render_template("remove_game.html", deleted=deleted, base64_vals="",
+                           search_term=None)
 
 
 @app.route("/add_account")
 @login_required
 def serve_add_account(errors=""):
-    with open(settings["secrets_file"], "r") as file:
-        secrets = json.load(file)
-    username = current_user.username
-    place_holder = "<!-- ### -->"
     error = ""
     if errors == "mismatch_password":
         error = "Passwords do not match!"
@@ -444,34 +854,18 @@ def serve_add_account(errors=""):
         error = "That username is taken!"
     elif errors == "account_created":
         error = "Account Created Successfully!"
-    temp = render_template("create_account.html", error=error)
-    radio_button = """
-    <input type="radio" id="%s" name="hash_algo" value="%s" %s>
-    <label for="%s">%s</label><br>
-    """
-    output = []
-    for each in hash.algorithms_guaranteed:
-        if "shake" not in each:
-            if each == secrets[username]["hash_algo"]:
-                output.append(radio_button % (each, each, "checked", each, each))
-            else:
-                output.append(radio_button % (each, each, "", each, each))
-    output = "</br>".join(output)
-    temp = temp.replace(place_holder, output)
-    return temp
+    elif errors == "busy":
+        error = "The server is busy. Please try again in a moment."
+    return render_template("create_account.html", error=error, kdfs=KDFS, kdf=passwords.kdf)
 
 
 @app.route("/add_account", methods=["POST"])
 @login_required
 def add_account():
-    # Load a local copy of the auth file
-    with open(settings["secrets_file"], "r") as file:
-        secrets = json.load(file)
     username = request.form.get("username")
     password = request.form.get("password")
     password_check = request.form.get("password_check")
-    hash_algo = request.form.get("hash_algo")
-    hash_number = int(request.form.get("hash_number"))
+    kdf = request.form.get("kdf", passwords.kdf)
     removable = request.form.get("removable")
     if removable == "on":
         removable = True
@@ -482,18 +876,22 @@ def add_account():
         return serve_add_account(errors="mismatch_password")
     # Check username
     del password_check
-    if username in secrets:
+    if credentials.get_user(username) is not None:
         return serve_add_account(errors="username_taken")
-    gen_hash = password
-    hash_func = getattr(hash, hash_algo)
-    for each in range(hash_number):
-        gen_hash = hash_func(gen_hash.encode()).hexdigest()
-    secrets[username] = {"password_hash": gen_hash, "hash_algo": hash_algo,
-                         "rehash_count": hash_number, "removable": removable}
-    with open(settings["secrets_file"], "w") as file:
-        json.dump(secrets, file, indent=2)
+    if kdf not in KDFS:
+        kdf = passwords.kdf
+    try:
+        record = passwords.make(password, kdf=kdf)
+    except Busy:
+        return serve_add_account(errors="busy")
+    record = {each: value for each, value in record.items() if value is not None}
+    record["removable"] = removable
+    # Checked again under the store's lock, in case someone beat us to it
+    added = credentials.add_user(username, record)
     # Delete everything we had in memory to make it harder to access in compromised situations
-    del secrets, hash_func, gen_hash, password, username, hash_algo, hash_number
+    del record, password, username, kdf
+    if not added:
+        return serve_add_account(errors="username_taken")
     return serve_add_account(errors="account_created")
 
 
@@ -501,35 +899,17 @@ def add_account():
 @login_required
 def serve_remove_account(errors=""):
     """Serve remove account"""
-    with open(settings["secrets_file"], "r") as file:
-        secrets = json.load(file)
+    users = credentials.users()
     username = current_user.username
-    if secrets[username]["removable"]:
+    if users[username]["removable"]:
         return render_template("forbidden.html", username=username)
-    place_holder = "<!-- ### -->"
     error = ""
     if errors == "missing_account":
         error = "Account Not Found!"
     elif errors == "account_removed":
         error = "Account Removed Successfully!"
-    temp = render_template("remove_account.html", error=error)
-    radio_button = """
-    <input type="radio" id="%s" name="remove" value="%s">
-    <label for="%s">%s</label><br>
-    """
-    output = []
-    workable = {}
-    for each in secrets:
-        if isinstance(secrets[each], dict):
-            workable[each] = secrets[each]
-    for each in workable:
-        if workable[each]["removable"]:
-            output.append(radio_button % (each, each, each, each))
-    if output == []:
-        output.append("No removable accounts found")
-    output = "</br>".join(output)
-    temp = temp.replace(place_holder, output)
-    return temp
+    accounts = [each for each in users if users[each].get("removable")]
+    return render_template("remove_account.html", error=error, accounts=accounts)
 
 
 @app.route("/remove_account", methods=["POST"])
@@ -537,13 +917,8 @@ def serve_remove_account(errors=""):
 def remove_account():
     """Remove accounts"""
     account = request.form.get("remove")
-    with open(settings["secrets_file"], "r") as file:
-        secrets = json.load(file)
-    if account not in secrets:
-        return serve_remove_account(error="missing_account")
-    del secrets[account]
-    with open(settings["secrets_file"], "w") as file:
-        json.dump(secrets, file, indent=2)
+    if not credentials.remove_user(account):
+        return serve_remove_account(errors="missing_account")
     return serve_remove_account(errors="account_removed")
 
 
@@ -551,9 +926,7 @@ def remove_account():
 @login_required
 def serve_edit_account(errors=""):
     """Edit your account"""
-    with open(settings["secrets_file"], "r") as file:
-        secrets = json.load(file)
-    place_holder = "<!-- ### -->"
+    record = credentials.get_user(current_user.username)
     error = ""
     if errors == "edit_success":
         error = "Account Change Successfull!"
@@ -561,56 +934,40 @@ def serve_edit_account(errors=""):
         error = "Passwords do not match!"
     elif errors == "unknown_password":
         error = "In order to change hashing settings, you must reset or change your password."
+    elif errors == "busy":
+        error = "The server is busy. Please try again in a moment."
     username = current_user.username
-    hash_count = secrets[username]["rehash_count"]
-    temp = render_template("edit_account.html", error=error, username=username,
-                           hash_number=hash_count)
-    radio_button = """
-    <input type="radio" id="%s" name="hash_algo" value="%s" %s>
-    <label for="%s">%s</label><br>
-    """
-    output = []
-    for each in hash.algorithms_guaranteed:
-        if "shake" not in each:
-            if each == secrets[username]["hash_algo"]:
-                output.append(radio_button % (each, each, "checked", each, each))
-            else:
-                output.append(radio_button % (each, each, "", each, each))
-    output = "</br>".join(output)
-    temp = temp.replace(place_holder, output)
-    return temp
+    return render_template("edit_account.html", error=error, username=username, kdfs=KDFS,
+                           kdf=record.get("kdf", passwords.kdf))
 
 
 @app.route("/edit_account", methods=["POST"])
 @login_required
 def edit_account(errors=""):
     """Edit account"""
-    with open(settings["secrets_file"], "r") as file:
-        secrets = json.load(file)
     username = current_user.username
     password = request.form.get("password")
     password_check = request.form.get("password_check")
-    hash_algo = request.form.get("hash_algo")
-    hash_number = int(request.form.get("hash_number"))
+    kdf = request.form.get("kdf", passwords.kdf)
+    record = credentials.get_user(username)
     if password != password_check:
         return serve_edit_account(errors="mismatch_password")
-    if ((hash_algo != secrets[username]["hash_algo"]) and ("" in (password, password_check))):
-        return serve_edit_account(errors="unknown_password")
-    if ((hash_number != secrets[username]["rehash_count"]) and ("" in (password, password_check))):
-        return serve_edit_account(errors="unknown_password")
+    if kdf not in KDFS:
+        kdf = passwords.kdf
+    if password in ("", None):
+        # Nothing to hash, so there is nothing to change
+        if kdf != record.get("kdf", passwords.kdf):
+            return serve_edit_account(errors="unknown_password")
+        return serve_edit_account(errors="edit_success")
     del password_check
-    gen_hash = password
-    hash_func = getattr(hash, hash_algo)
-    for each in range(hash_number):
-        gen_hash = hash_func(gen_hash.encode()).hexdigest()
-    secrets[username]["password_hash"] = gen_hash
-    secrets[username]["rehash_count"] = hash_number
-    secrets[username]["hash_algo"] = hash_algo
-    with open(settings["secrets_file"], "w") as file:
-        json.dump(secrets, file, indent=2)
-    del secrets, hash_func, gen_hash, password, username, hash_algo, hash_number
+    try:
+        changes = passwords.make(password, kdf=kdf)
+    except Busy:
+        return serve_edit_account(errors="busy")
+    credentials.update_user(username, **changes)
+    del record, changes, password, username, kdf
     return serve_edit_account(errors="edit_success")
 
 
 if __name__ == "__main__":
-    app.run()
+    create_app().run()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  suggest.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Type-ahead suggestions for game names and tags
+
+Every name and tag is indexed under each of its word-starts, lower cased,
+with anything that is not a letter or digit turned into a space, so "wes"
+and "battle for" both find Battle_for_Wesnoth. The terms are kept in one
+sorted list, so a prefix's matches are a slice of it found with bisect.
+
+Prefixes matching few terms just have their slice scanned. Those matching
+many have their best matches cached, found the first time by walking the
+entries from the heaviest down until enough match. The cache is kept up to
+date as weights grow, which is all download counts ever do, and dropped for
+a prefix only when one of its best matches shrinks or goes away.
+"""
+import bisect
+import heapq
+import threading
+from search_index import TERM_SPLIT
+
+
+# Above this many matching terms, a prefix's best matches are cached
+SCAN_LIMIT = 256
+
+
+def normalize(text):
+    """Lower case `text', with every run of other characters a single space"""
+    return TERM_SPLIT.sub(" ", text.lower())
+
+
+def words(label):
+    """Get the normalized words of a name or tag"""
+    return [each for each in TERM_SPLIT.split(label.lower()) if each != ""]
+
+
+def terms(label):
+    """Get the terms a name or tag is indexed under: the label from each of
+    its word-starts on
+    """
+    label = words(label)
+    return [" ".join(label[start:]) for start in range(len(label))]
+
+
+def tag_entries(game):
+    """Get the entries of a game's tags"""
+    keys = [("genre", each) for each in game.genres if each != ""]
+    if game.rating:
+        keys.append(("rating", game.rating))
+    if game.platform:
+        keys.append(("platform", game.platform))
+    return keys
+
+
+def catalog_weights(games):
+    """Get the entries for every game and tag in the catalog, weighted by
+    downloads
+
+    A tag weighs the downloads of every game that has it.
+    """
+    weights = {}
+    tags = {}
+    for game in games:
+        weights[("game", game.name)] = game.downloads
+        for key in tag_entries(game):
+            tags[key] = tags.get(key, 0) + game.downloads
+    weights.update(tags)
+    return weights
+
+
+def download_changes(changed):
+    """Get how much the weight of each entry changes, for a list of (old
+    Game, new Game) pairs that only differ in downloads
+    """
+    changes = {}
+    for old, new in changed:
+        delta = new.downloads - old.downloads
+        for key in [("game", new.name)] + tag_entries(new):
+            changes[key] = changes.get(key, 0) + delta
+    return changes
+
+
+class PrefixIndex:
+    """Names and tags, searchable by prefix, best first
+
+    Entries are (kind, label) tuples, weighted by downloads. At most `size'
+    matches are returned for any prefix.
+    """
+    def __init__(self, size=20):
+        self.size = size
+        self._terms = []
+        self._entries = []
+        # (-weight, entry), heaviest first
+        self._order = []
+        self._weights = {}
+        self._top = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._weights)
+
+    def _insert(self, entry):
+        for term in terms(entry[1]):
+            position = bisect.bisect_left(self._terms, term)
+            self._terms.insert(position, term)
+            self._entries.insert(position, entry)
+
+    def _delete(self, entry):
+        for term in terms(entry[1]):
+            position = bisect.bisect_left(self._terms, term)
+            while self._entries[position] != entry:
+                position += 1
+            del self._terms[position]
+            del self._entries[position]
+        del self._order[bisect.bisect_left(self._order, (-self._weights.pop(entry), entry))]
+
+    def _cached(self, entry):
+        """Get the cached best matches of every prefix of `entry''s terms"""
+        output = []
+        if self._top == {}:
+            return output
+        for term in terms(entry[1]):
+            for end in range(1, len(term) + 1):
+                best = self._top.get(term[:end])
+                if best is not None:
+                    output.append((term[:end], best))
+        return output
+
+    def _grow(self, entry, weight):
+        """Move `entry' up to `weight' in the cached best matches"""
+        for prefix, best in self._cached(entry):
+            best = [each for each in best if each[1] != entry]
+            best.append((-weight, entry))
+            best.sort()
+            self._top[prefix] = best[:self.size]
+
+    def _shrink(self, entry):
+        """Drop the cached best matches `entry' is in, before it shrinks or goes"""
+        for prefix, best in self._cached(entry):
+            if any(each[1] == entry for each in best):
+                del self._top[prefix]
+
+    def _rebuild(self, weights):
+        """Index `weights' from scratch, which beats inserting one at a time
+        once a lot has changed
+        """
+        pairs = sorted((term, entry) for entry in weights for term in terms(entry[1]))
+        self._terms = [each[0] for each in pairs]
+        self._entries = [each[1] for each in pairs]
+        self._order = sorted((-weight, entry) for entry, weight in weights.items())
+        self._weights = dict(weights)
+        self._top = {}
+
+    def sync(self, weights):
+        """Bring the index in line with `weights', a dict of entry to weight
+
+        Only entries that were added, removed or changed are touched.
+        """
+        with self._lock:
+            removed = [each for each in self._weights if each not in weights]
+            added = len(weights) - (len(self._weights) - len(removed))
+            if len(removed) + added > max(SCAN_LIMIT, len(self._weights) // 16):
+                self._rebuild(weights)
+                return
+            for entry in removed:
+                self._shrink(entry)
+                self._delete(entry)
+            for entry, weight in weights.items():
+                self._set(entry, weight)
+
+    def add(self, changes):
+        """Add to the weights of entries already indexed, from a dict of entry
+        to how much its weight changes
+        """
+        with self._lock:
+            for entry, change in changes.items():
+                if entry in self._weights:
+                    self._set(entry, self._weights[entry] + change)
+
+    def _set(self, entry, weight):
+        """Add `entry', or move it to its new weight"""
+        old = self._weights.get(entry)
+        if old == weight:
+            return
+        if old is None:
+            self._insert(entry)
+        else:
+            if weight < old:
+                self._shrink(entry)
+            del self._order[bisect.bisect_left(self._order, (-old, entry))]
+        bisect.insort(self._order, (-weight, entry))
+        self._weights[entry] = weight
+        self._grow(entry, weight)
+
+    def _scan(self, start, end):
+        """Find the best entries among the terms from `start' to `end'"""
+        entries = set(self._entries[start:end])
+        return heapq.nsmallest(self.size, [(-self._weights[each], each) for each in entries])
+
+    def _walk(self, prefix):
+        """Find the best entries matching `prefix', heaviest first"""
+        best = []
+        prefix = " " + prefix
+        for weight, entry in self._order:
+            if prefix in " " + " ".join(words(entry[1])):
+                best.append((weight, entry))
+                if len(best) == self.size:
+                    break
+        return best
+
+    def search(self, prefix, count=None):
+        """Get the best (kind, label, weight) matches for `prefix'"""
+        prefix = normalize(prefix).lstrip(" ")
+        if prefix == "":
+            return []
+        with self._lock:
+            best = self._top.get(prefix)
+            if best is None:
+                start = bisect.bisect_left(self._terms, prefix)
+                end = bisect.bisect_left(self._terms, prefix + "\U0010ffff", start)
+                if end - start <= SCAN_LIMIT:
+                    best = self._scan(start, end)
+                else:
+                    # Walking takes about size * terms / matches steps
+                    if (end - start) ** 2 > self.size * len(self._terms):
+                        best = self._walk(prefix)
+                    else:
+                        best = self._scan(start, end)
+                    self._top[prefix] = best
+        if count is not None:
+            best = best[:count]
+        return [(entry[0], entry[1], -weight) for weight, entry in best]
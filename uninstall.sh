@@ -26,8 +26,9 @@ echo "Removing files and disabling. . ."
 # Stop and disable start up service
 sudo systemctl stop store_backend
 sudo systemctl disable store_backend
+sudo systemctl disable --now store_links.timer
 # remove system files
-sudo rm -fv /etc/nginx/sites-available/store_backend.conf /etc/nginx/sites-enabled/store_backend.conf /etc/systemd/system/store_backend.service
+sudo rm -fv /etc/nginx/sites-available/store_backend.conf /etc/nginx/sites-enabled/store_backend.conf /etc/systemd/system/store_backend.service /etc/systemd/system/store_links.service /etc/systemd/system/store_links.timer
 # restart nginx to take the site offline
 sudo systemctl restart nginx
 # remove commit tag
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  workers.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Starting things once in each uWSGI worker
+
+Threads don't survive a fork, so anything that runs one has to start it
+again in every worker. Doing it the first time a worker needs it, rather than
+at import, also means the uWSGI master never has a thread running, or a lock
+held, when it forks.
+"""
+import os
+import threading
+
+
+class PerProcess:
+    """Calls `start' once in each process, the first time this is called
+
+    `lock' is held while `start' runs. Pass the lock guarding whatever
+    `start' resets, if it has one.
+    """
+    def __init__(self, start, lock=None):
+        self.start = start
+        self._lock = threading.Lock() if lock is None else lock
+        self._pid = None
+
+    def __call__(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.start()
+            self._pid = os.getpid()
+
+    def started(self):
+        """Whether `start' has run in this process"""
+        return self._pid == os.getpid()
@@ -22,7 +22,9 @@
 #
 #
 """WSGI Loader"""
-from store import app
+from store import create_app
+
+app = create_app()
 
 if __name__ == "__main__":
     app.run()